@@ -9,3 +9,28 @@ create table if not exists jobs (
 	layers varchar
 );
 
+alter table jobs add column if not exists progress varchar;
+
+create table if not exists layer_stats (
+	layer varchar primary key,
+	samples integer not null default 0,
+	seconds double precision not null default 0,
+	rows double precision not null default 0,
+	bytes double precision not null default 0
+);
+
+alter table jobs add column if not exists updated_at timestamp default now();
+
+create index if not exists jobs_status_idx on jobs (status);
+create index if not exists jobs_data_id_idx on jobs (data_id);
+
+alter table jobs add column if not exists format varchar default 'gpkg';
+
+alter table jobs add column if not exists idempotency_key varchar;
+alter table jobs add column if not exists request_key varchar;
+
+create unique index if not exists jobs_idempotency_key_idx on jobs (idempotency_key);
+create index if not exists jobs_request_key_idx on jobs (request_key);
+
+alter table jobs add column if not exists srid integer;
+alter table jobs add column if not exists layer_srids varchar;
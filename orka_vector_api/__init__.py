@@ -8,10 +8,20 @@ from werkzeug.middleware.proxy_fix import ProxyFix
 
 from orka_vector_api import logging_config
 from orka_vector_api.logging_config import setup_file_logger
+from orka_vector_api.asset_cache import AssetCache
+from orka_vector_api.layer_registry import LayerRegistry
 from orka_vector_api.orka_db import OrkaDB
+from orka_vector_api.profiler import Profiler
+from orka_vector_api.rate_limiter import RateLimiter
+from orka_vector_api.scheduler import JobScheduler
 from orka_vector_api.swagger_config import get_swagger_config
 
 db = OrkaDB()
+layer_registry = LayerRegistry()
+scheduler = JobScheduler()
+rate_limiter = RateLimiter()
+profiler = Profiler()
+asset_cache = AssetCache()
 swagger = Swagger(template=get_swagger_config())
 
 
@@ -35,6 +45,30 @@ def create_app(test_config=None):
         # load the test config if passed in
         app.config.from_mapping(test_config)
 
+    app.config.setdefault('ORKA_PROGRESS_INTERVAL', 5)
+    app.config.setdefault('ORKA_LAYER_RETRIES', 2)
+    app.config.setdefault('ORKA_LAYER_RETRY_BACKOFF', 2)
+    app.config.setdefault('ORKA_REAPER_INTERVAL', 600)
+    app.config.setdefault('ORKA_REAPER_BATCH_SIZE', 500)
+    app.config.setdefault('ORKA_REAPER_STALE_AFTER', None)
+    app.config.setdefault('ORKA_HEARTBEAT_INTERVAL', 60)
+    app.config.setdefault('ORKA_JOB_TTL', {})
+    app.config.setdefault('ORKA_GPKG_DISK_BUDGET', None)
+    app.config.setdefault('ORKA_DOWNLOAD_TOKEN_TTL', 3600)
+    app.config.setdefault('ORKA_EXPORT_ENGINE', 'ogr2ogr')
+    app.config.setdefault('ORKA_FAKE_LAYER_SECONDS', 1)
+    app.config.setdefault('ORKA_FAKE_LAYER_ROWS', 100)
+    app.config.setdefault('ORKA_DEFAULT_SRID', 25833)
+    app.config.setdefault('ORKA_LAYER_SRIDS', {})
+    app.config.setdefault('ORKA_MBTILES_MIN_ZOOM', 0)
+    app.config.setdefault('ORKA_MBTILES_MAX_ZOOM', 14)
+    app.config.setdefault('ORKA_MBTILES_WORKERS', 4)
+    app.config.setdefault('ORKA_MBTILES_BATCH_SIZE', 256)
+    app.config.setdefault('ORKA_API_KEYS', {})
+    app.config.setdefault('ORKA_API_KEY_HEADER', 'X-Api-Key')
+    app.config.setdefault('ORKA_DEFAULT_PRIORITY', 'interactive')
+    app.config.setdefault('ORKA_IDEMPOTENCY_HEADER', 'Idempotency-Key')
+
     # ensure the instance folder exists
     try:
         os.makedirs(app.instance_path)
@@ -46,15 +80,30 @@ def create_app(test_config=None):
     app.logger.setLevel(app.config['ORKA_LOG_LEVEL'])
 
     db.init_app(app)
+    layer_registry.init_app(app)
+    scheduler.init_app(app)
+    rate_limiter.init_app(app)
+    profiler.init_app(app)
+    asset_cache.init_app(app)
     swagger.init_app(app)
 
     from orka_vector_api.views.status import status
     from orka_vector_api.views.jobs import jobs
     from orka_vector_api.views.data import data
+    from orka_vector_api.views.layers import layers
 
     app.register_blueprint(status)
     app.register_blueprint(jobs)
     app.register_blueprint(data)
+    app.register_blueprint(layers)
+
+    if app.config['ORKA_PROFILING']:
+        from orka_vector_api.views.debug import debug
+        app.register_blueprint(debug)
+
+    from orka_vector_api.helper import start_reaper, start_heartbeat
+    start_reaper(app)
+    start_heartbeat(app)
 
     if app.config['ENV'] == 'development':
         return app
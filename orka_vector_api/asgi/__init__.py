@@ -0,0 +1,37 @@
+from starlette.applications import Starlette
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.routing import Mount, Route
+
+from orka_vector_api import create_app
+from orka_vector_api.asgi.orka_async_db import OrkaAsyncDB
+from orka_vector_api.asgi import views
+
+
+def create_asgi_app(test_config=None):
+    """Create the ASGI app.
+
+    The status, polling and download endpoints are served by async handlers.
+    All other routes, including the swagger spec and the creation of jobs, are
+    passed to the Flask app.
+    """
+    wsgi_app = create_app(test_config)
+    # create_app wraps the Flask app in ProxyFix outside of development
+    flask_app = getattr(wsgi_app, 'app', wsgi_app)
+    flask_app.config.setdefault('ORKA_ASYNC_DB_MIN_CONNECTION', 1)
+    flask_app.config.setdefault('ORKA_ASYNC_DB_MAX_CONNECTION', 10)
+
+    async_db = OrkaAsyncDB(flask_app.config)
+
+    routes = [
+        Route('/status/', views.get_status, methods=['GET']),
+        Route('/jobs/{job_id:int}', views.get_job, methods=['GET']),
+        Route('/data/styles', views.get_styles_zip, methods=['GET']),
+        Route('/data/groups', views.get_layer_groups, methods=['GET']),
+        Route('/data/{data_id}', views.get_data, methods=['GET']),
+        Mount('/', app=WSGIMiddleware(wsgi_app))
+    ]
+
+    app = Starlette(routes=routes, on_startup=[async_db.connect], on_shutdown=[async_db.close])
+    app.state.flask_app = flask_app
+    app.state.db = async_db
+    return app
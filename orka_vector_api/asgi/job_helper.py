@@ -0,0 +1,38 @@
+from orka_vector_api.helper.job_helper import _JOB_COLUMNS, _parse_job, _is_sane_schema
+
+
+async def get_job_by_id(job_id, pool, config):
+    schema = _get_schema(config)
+    cols = ', '.join([_quote_ident(k) for k in _JOB_COLUMNS])
+    q = f'SELECT {cols} FROM {schema}.{_quote_ident("jobs")} WHERE id = $1;'
+
+    row = await pool.fetchrow(q, job_id)
+    if row is None:
+        return None
+    return _parse_job(dict(row))
+
+
+async def get_job_id_by_dataid(data_id, pool, config):
+    schema = _get_schema(config)
+    q = f'SELECT id FROM {schema}.{_quote_ident("jobs")} WHERE data_id = $1 LIMIT 1;'
+
+    return await pool.fetchval(q, data_id)
+
+
+async def get_layer_stats(pool, config, layers):
+    schema = _get_schema(config)
+    q = f'SELECT layer, seconds FROM {schema}.{_quote_ident("layer_stats")} WHERE layer = ANY($1::varchar[]);'
+
+    rows = await pool.fetch(q, list(layers))
+    return {row['layer']: row['seconds'] for row in rows}
+
+
+def _get_schema(config):
+    schema = config['ORKA_DB_SCHEMA']
+    if not _is_sane_schema(schema):
+        raise Exception('Schema is not sane.')
+    return _quote_ident(schema)
+
+
+def _quote_ident(ident):
+    return '"' + ident.replace('"', '""') + '"'
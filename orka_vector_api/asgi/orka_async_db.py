@@ -0,0 +1,25 @@
+import asyncpg
+
+
+class OrkaAsyncDB(object):
+    """Async counterpart of OrkaDB that holds an asyncpg pool for the application database."""
+
+    def __init__(self, config):
+        self.config = config
+        self.pool = None
+
+    async def connect(self):
+        self.pool = await asyncpg.create_pool(
+            min_size=self.config['ORKA_ASYNC_DB_MIN_CONNECTION'],
+            max_size=self.config['ORKA_ASYNC_DB_MAX_CONNECTION'],
+            host=self.config['ORKA_DB_HOST'],
+            port=self.config['ORKA_DB_PORT'],
+            database=self.config['ORKA_DB_DATABASE'],
+            user=self.config['ORKA_DB_USER'],
+            password=self.config['ORKA_DB_PASSWORD']
+        )
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
@@ -0,0 +1,105 @@
+import os
+import uuid
+from urllib.parse import urlencode
+
+from starlette.responses import FileResponse, JSONResponse, Response
+
+from orka_vector_api import asset_cache
+from orka_vector_api.asgi.job_helper import get_job_by_id, get_job_id_by_dataid, get_layer_stats
+from orka_vector_api.enums import Status
+from orka_vector_api.helper import create_download_token, estimate_eta, get_eta_layers, verify_download_token, \
+    find_output_file
+
+
+async def get_status(request):
+    return JSONResponse({
+        'status': 'active'
+    })
+
+
+async def get_job(request):
+    app = request.app.state.flask_app
+    pool = request.app.state.db.pool
+    job_id = request.path_params['job_id']
+    try:
+        job = await get_job_by_id(job_id, pool, app.config)
+        if job is None:
+            app.logger.info(f'Could not get job {job_id}. Job not found.')
+            return Response('', status_code=404)
+        if job['status'] != Status.CREATED.value:
+            job.pop('data_id')
+        else:
+            token = create_download_token(app, job['data_id'])
+            job['download_token'] = token
+            job['download_url'] = request.scope.get('root_path', '') + \
+                f'/data/{job["data_id"]}?' + urlencode({'token': token})
+        job['eta'] = None
+        if job['status'] == Status.RUNNING.value and job['progress'] is not None:
+            layer_stats = await get_layer_stats(pool, app.config, get_eta_layers(job['progress']))
+            job['eta'] = estimate_eta(job['progress'], layer_stats)
+        return JSONResponse(job)
+    except Exception as e:
+        app.logger.info(f'Error getting job. {e}')
+        return Response('', status_code=500)
+
+
+async def get_data(request):
+    app = request.app.state.flask_app
+    pool = request.app.state.db.pool
+    try:
+        data_id_str = str(uuid.UUID(request.path_params['data_id']))
+    except ValueError:
+        return Response('', status_code=404)
+    gpkg_path = app.config['ORKA_GPKG_PATH']
+    output_file = find_output_file(gpkg_path, data_id_str)
+    if output_file is None:
+        app.logger.info(f'Could not provide download for {data_id_str}. File not found.')
+        return Response('', status_code=404)
+    file_path, output_format = output_file
+    filename = os.path.basename(file_path)
+
+    token = request.query_params.get('token')
+    if token is not None:
+        if not verify_download_token(app, token, data_id_str):
+            app.logger.info(f'Could not provide download for {filename}. Invalid download token.')
+            return Response('', status_code=403)
+    else:
+        try:
+            # only return a file if it is related to an existing job
+            job_id = await get_job_id_by_dataid(data_id_str, pool, app.config)
+        except Exception as e:
+            app.logger.info(f'Error downloading gpkg. {e}')
+            return Response('', status_code=404)
+        if job_id is None:
+            app.logger.info(f'Could not provide download for {filename}. No corresponding job found.')
+            return Response('', status_code=404)
+
+    try:
+        response = FileResponse(file_path, media_type=output_format.mimetype, filename=filename)
+    except Exception as e:
+        app.logger.info(f'Error downloading gpkg. {e}')
+        return Response('', status_code=500)
+    app.logger.debug(f'Provided download for {filename}.')
+    return response
+
+
+async def get_styles_zip(request):
+    return _get_asset(request, 'styles')
+
+
+async def get_layer_groups(request):
+    return _get_asset(request, 'groups')
+
+
+def _get_asset(request, name):
+    app = request.app.state.flask_app
+    response = asset_cache.respond(name, if_none_match=request.headers.get('if-none-match'),
+                                   accept_encoding=request.headers.get('accept-encoding'),
+                                   version=request.query_params.get('v'))
+    if response is None:
+        app.logger.info(f'Could not provide download for {name}. File not found.')
+        return Response('', status_code=404)
+
+    body, code, headers = response
+    app.logger.debug(f'Provided download for {name} with status {code}.')
+    return Response(body, status_code=code, headers=headers)
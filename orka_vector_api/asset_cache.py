@@ -0,0 +1,162 @@
+import gzip
+import hashlib
+import os
+import time
+from threading import Lock
+
+# gzip variants that save less are not worth the decompression on the client
+_MIN_GZIP_RATIO = 0.9
+
+
+class _Asset(object):
+    def __init__(self, body, mimetype, signature):
+        self.body = body
+        self.mimetype = mimetype
+        self.signature = signature
+        digest = hashlib.sha256(body).hexdigest()
+        self.version = digest[:16]
+        self.etag = f'"{digest}"'
+        compressed = gzip.compress(body, mtime=0)
+        if len(compressed) < len(body) * _MIN_GZIP_RATIO:
+            self.gzip_body = compressed
+            self.gzip_etag = f'"{digest}-gzip"'
+        else:
+            self.gzip_body = None
+            self.gzip_etag = None
+
+
+class AssetCache(object):
+    """Holds the style zip and the layer groups json in memory.
+
+    The files are loaded on startup and reloaded when they change. Each asset
+    has a strong ETag and, if it compresses well, a precompressed gzip variant.
+    Requests with the content hash as `v` parameter may cache the asset forever,
+    all others have to revalidate it, which is answered with 304 as long as the
+    asset did not change.
+    """
+
+    def __init__(self, app=None):
+        self.app = app
+        self.files = {}
+        self.assets = {}
+        self.last_check = 0
+        self.lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ORKA_ASSET_CHECK_INTERVAL', 2)
+        app.config.setdefault('ORKA_ASSET_MAX_AGE', 365 * 24 * 3600)
+
+        self.app = app
+        self.check_interval = app.config['ORKA_ASSET_CHECK_INTERVAL']
+        self.max_age = app.config['ORKA_ASSET_MAX_AGE']
+        style_path = os.path.abspath(app.config['ORKA_STYLE_PATH'])
+        self.files = {
+            'styles': (os.path.join(style_path, app.config['ORKA_STYLE_FILE']), 'application/zip'),
+            'groups': (os.path.join(style_path, app.config['ORKA_LAYER_GROUPS_FILE']), 'application/json')
+        }
+        with self.lock:
+            self.assets = {}
+            self._reload()
+
+    def get(self, name):
+        """Get the current version of an asset, or None if its file does not exist."""
+        self._reload_if_changed()
+        return self.assets.get(name)
+
+    def respond(self, name, if_none_match=None, accept_encoding=None, version=None):
+        """Get body, status and headers of the response to a request of an asset.
+
+        Returns None if the asset does not exist.
+        """
+        asset = self.get(name)
+        if asset is None:
+            return None
+
+        use_gzip = asset.gzip_body is not None and _accepts_gzip(accept_encoding)
+        etag = asset.gzip_etag if use_gzip else asset.etag
+        headers = {
+            'ETag': etag,
+            # tells clients the url they may cache forever
+            'Content-Location': f'?v={asset.version}'
+        }
+        if version == asset.version:
+            headers['Cache-Control'] = f'public, max-age={self.max_age}, immutable'
+        else:
+            headers['Cache-Control'] = 'no-cache'
+        if asset.gzip_body is not None:
+            headers['Vary'] = 'Accept-Encoding'
+
+        if _etag_matches(if_none_match, [asset.etag, asset.gzip_etag]):
+            return b'', 304, headers
+
+        headers['Content-Type'] = asset.mimetype
+        if use_gzip:
+            headers['Content-Encoding'] = 'gzip'
+            return asset.gzip_body, 200, headers
+        return asset.body, 200, headers
+
+    def _reload_if_changed(self):
+        if time.time() - self.last_check < self.check_interval:
+            return
+        with self.lock:
+            if time.time() - self.last_check < self.check_interval:
+                return
+            self._reload()
+
+    def _reload(self):
+        """Load all assets whose files changed. Must be called with the lock held."""
+        self.last_check = time.time()
+        assets = dict(self.assets)
+        for name, (file_path, mimetype) in self.files.items():
+            signature = _get_signature(file_path)
+            asset = assets.get(name)
+            if asset is not None and asset.signature == signature:
+                continue
+            if signature is None:
+                assets.pop(name, None)
+                continue
+            try:
+                with open(file_path, 'rb') as f:
+                    body = f.read()
+            except OSError as e:
+                self.app.logger.warning(f'Could not load asset {file_path}. {e}')
+                assets.pop(name, None)
+                continue
+            self.app.logger.info(f'Loaded asset {file_path}.')
+            assets[name] = _Asset(body, mimetype, signature)
+        self.assets = assets
+
+
+def _get_signature(file_path):
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _accepts_gzip(accept_encoding):
+    if accept_encoding is None:
+        return False
+    for item in accept_encoding.split(','):
+        parts = [p.strip() for p in item.split(';')]
+        if parts[0].lower() not in ['gzip', '*']:
+            continue
+        q = [p for p in parts[1:] if p.startswith('q=')]
+        try:
+            return len(q) == 0 or float(q[0][2:]) > 0
+        except ValueError:
+            return False
+    return False
+
+
+def _etag_matches(if_none_match, etags):
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    # If-None-Match uses the weak comparison, so W/ prefixes are ignored
+    candidates = [t.strip()[2:] if t.strip().startswith('W/') else t.strip() for t in if_none_match.split(',')]
+    return True in [e is not None and e in candidates for e in etags]
@@ -1 +1,2 @@
 from .status import *
+from .output_format import *
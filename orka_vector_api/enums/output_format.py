@@ -0,0 +1,12 @@
+from enum import Enum
+
+
+class OutputFormat(Enum):
+    GPKG = 'gpkg'
+    MBTILES = 'mbtiles'
+
+    @property
+    def mimetype(self):
+        if self == OutputFormat.MBTILES:
+            return 'application/vnd.mapbox-vector-tile+sqlite3'
+        return 'application/geopackage+sqlite3'
@@ -3,6 +3,7 @@ from enum import Enum
 
 class Status(Enum):
     INIT = 'INIT'
+    QUEUED = 'QUEUED'
     RUNNING = 'RUNNING'
     CREATED = 'CREATED'
     ERROR = 'ERROR'
@@ -10,4 +11,8 @@ class Status(Enum):
     BBOX_TOO_BIG = 'BBOX_TOO_BIG'
     BBOX_INVALID = 'BBOX_INVALID'
     LAYERS_INVALID = 'LAYERS_INVALID'
+    FORMAT_INVALID = 'FORMAT_INVALID'
+    SRID_INVALID = 'SRID_INVALID'
     NO_THREADS_AVAILABLE = 'NO_THREADS_AVAILABLE'
+    RATE_LIMITED = 'RATE_LIMITED'
+    IDEMPOTENCY_KEY_REUSED = 'IDEMPOTENCY_KEY_REUSED'
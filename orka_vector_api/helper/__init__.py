@@ -1,2 +1,8 @@
+from .client_helper import *
+from .fake_helper import *
 from .gdal_helper import *
 from .job_helper import *
+from .mbtiles_helper import *
+from .progress_helper import *
+from .reaper_helper import *
+from .token_helper import *
@@ -0,0 +1,43 @@
+import hashlib
+
+
+def get_client(app, request):
+    """Identify the client of a request.
+
+    Clients with a configured API key are identified by the name of their client
+    or a hash of the key, all others by their IP address. Returns the client id and the scheduling and rate limit
+    settings of the client.
+    """
+    api_keys = app.config['ORKA_API_KEYS']
+    api_key = request.headers.get(app.config['ORKA_API_KEY_HEADER'])
+    settings = api_keys.get(api_key) if api_key is not None else None
+
+    if settings is not None:
+        # the id ends up in logs and metrics, so it must not contain the key itself
+        client_id = 'key:' + settings.get('client', hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:12])
+    else:
+        settings = {}
+        # with ProxyFix, this is the address of the client and not of the proxy
+        client_id = 'ip:' + str(request.remote_addr)
+
+    priority = settings.get('priority', app.config['ORKA_DEFAULT_PRIORITY'])
+    rate_limit = app.config['ORKA_RATE_LIMITS'].get(priority, {})
+
+    return {
+        'id': client_id,
+        'priority': priority,
+        'max_concurrent': settings.get('max_concurrent', app.config['ORKA_CLIENT_MAX_CONCURRENT']),
+        'rate': settings.get('rate', rate_limit.get('rate')),
+        'burst': settings.get('burst', rate_limit.get('burst', 1))
+    }
+
+
+def get_idempotency_key(app, request, client):
+    """Get the idempotency key of a request, scoped to its client.
+
+    Returns None if the request has no idempotency key.
+    """
+    key = request.headers.get(app.config['ORKA_IDEMPOTENCY_HEADER'])
+    if key is None or len(key) == 0:
+        return None
+    return hashlib.sha256(f'{client["id"]}\n{key}'.encode('utf-8')).hexdigest()
@@ -0,0 +1,61 @@
+import logging
+import os
+import sqlite3
+import time
+
+from orka_vector_api import setup_file_logger
+from orka_vector_api.enums import OutputFormat
+from orka_vector_api.helper.gdal_helper import get_gpkg_filename, _get_layer_sqls
+from orka_vector_api.helper.progress_helper import _file_size
+
+
+def _create_fake_package(data_id, bbox, layers, timeout_e=None, error_e=None, db_props=None, gpkg_path='',
+                         layers_path='', layer_sqls=None, progress=None, package_format=OutputFormat.GPKG,
+                         seconds_per_layer=1, rows_per_layer=100, logfile='orka.log', loglevel='INFO', **kwargs):
+    """Simulate an export without the vector database, e.g. for load tests.
+
+    Each layer takes `seconds_per_layer` and is written as a plain sqlite table
+    with `rows_per_layer` rows, so progress, downloads and cleanup behave like
+    for a real export.
+    """
+    log_handler = setup_file_logger(logfile=logfile)
+    logger = logging.getLogger()
+    logger.addHandler(log_handler)
+    logger.setLevel(loglevel)
+    file_name = get_gpkg_filename(gpkg_path, data_id, partial=True, output_format=package_format)
+    if layer_sqls is None:
+        layer_sqls = _get_layer_sqls(layers_path, layer_names=layers)
+    if progress is not None:
+        if not os.path.exists(file_name):
+            progress.discard()
+        progress.start(list(layer_sqls.keys()))
+
+    package = sqlite3.connect(file_name)
+    try:
+        for layer_name in layer_sqls.keys():
+            if progress is not None and progress.is_done(layer_name):
+                continue
+            start = time.time()
+            size_before = _file_size(file_name)
+            if timeout_e is not None:
+                if timeout_e.wait(seconds_per_layer):
+                    break
+            else:
+                time.sleep(seconds_per_layer)
+            table = layer_name.replace('"', '""')
+            package.execute(f'DROP TABLE IF EXISTS "{table}";')
+            package.execute(f'CREATE TABLE "{table}" (fid integer PRIMARY KEY, minx real, miny real, maxx real, maxy real);')
+            package.executemany(f'INSERT INTO "{table}" (minx, miny, maxx, maxy) VALUES (?, ?, ?, ?);',
+                                [[float(b) for b in bbox]] * rows_per_layer)
+            package.commit()
+            if progress is not None:
+                progress.layer_done(layer_name,
+                                    rows=rows_per_layer,
+                                    size=_file_size(file_name) - size_before,
+                                    seconds=time.time() - start)
+    except Exception as e:
+        logger.info(f'Error creating fake package: {e}')
+        if error_e is not None:
+            error_e.set()
+    finally:
+        package.close()
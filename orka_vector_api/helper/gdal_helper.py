@@ -1,49 +1,204 @@
+import json
 import logging
 import os
 import subprocess
+import time
 from os import listdir
 from os.path import isfile, join, splitext
-from threading import Event, Thread
+from threading import Event, Lock, Thread
 
+import psycopg2
 from requests import put
 
-from orka_vector_api import setup_file_logger
-from orka_vector_api.enums import Status
+from orka_vector_api import setup_file_logger, layer_registry, profiler
+from orka_vector_api.enums import Status, OutputFormat
+from orka_vector_api.helper.progress_helper import ProgressReporter, _count_gpkg_rows, _file_size
+from orka_vector_api.profiler import NO_PROFILE
 
 
-def _get_gpkg_cmd(filename, layername, sql, host=None, port=None, database=None, user=None, password=None):
+# lower case stderr fragments of ogr2ogr that indicate a failure worth retrying. Permanent
+# failures like a wrong password or a missing database must not match, libpq reports
+# them as "connection to server ... failed" as well
+_TRANSIENT_ERRORS = [
+    'could not connect to server: connection refused',
+    'could not connect to server: connection timed out',
+    'failed: connection refused',
+    'failed: connection timed out',
+    'server closed the connection unexpectedly',
+    'terminating connection due to administrator command',
+    'terminating connection due to conflict with recovery',
+    'the database system is starting up',
+    'canceling statement due to lock timeout',
+    'deadlock detected',
+    'database is locked',
+    'too many clients already'
+]
+
+# data ids of the exports that have a running thread in this process
+_live_exports = set()
+_live_exports_lock = Lock()
+
+
+def _get_gpkg_cmd(filename, layername, sql, host=None, port=None, database=None, user=None, password=None,
+                  srid=25833, transform=True):
+    # reprojected by PostGIS if possible, so ogr2ogr only assigns the srs to keep gpkg_spatial_ref_sys consistent
+    srs_option = '-t_srs' if transform else '-a_srs'
+    # -overwrite instead of -append, so a retried layer replaces its partially written rows
     cmd = f'ogr2ogr -f "GPKG" {filename} ' \
           f'PG:"host={host} user={user} port={port} dbname={database} password={password}" ' \
           f'-sql "{sql}" ' \
           f'-nln "{layername}" ' \
-          f'-t_srs EPSG:25833 ' \
-          f'-append'
+          f'{srs_option} EPSG:{srid} ' \
+          f'-overwrite'
 
     return cmd
 
 
+def get_gpkg_filename(gpkg_path, data_id, partial=False, output_format=OutputFormat.GPKG):
+    """Get the absolute path of the data package of a job.
+
+    While a job is running, the layers are written to a partial staging file that
+    is only renamed to its final name once all layers are exported.
+    """
+    suffix = f'.partial.{output_format.value}' if partial else f'.{output_format.value}'
+    return os.path.abspath(os.path.join(gpkg_path, data_id + suffix))
+
+
+def get_output_filenames(gpkg_path, data_id):
+    """Get the paths of all final and partial data packages a job may have."""
+    return [get_gpkg_filename(gpkg_path, data_id, partial=partial, output_format=output_format)
+            for output_format in OutputFormat for partial in [False, True]]
+
+
+def find_output_file(gpkg_path, data_id):
+    """Find the final data package of a job and return its path and format, or None if it does not exist."""
+    for output_format in OutputFormat:
+        file_name = get_gpkg_filename(gpkg_path, data_id, output_format=output_format)
+        if os.path.isfile(file_name):
+            return file_name, output_format
+
+    return None
+
+
+def _is_transient_error(stderr):
+    stderr = stderr.lower()
+    return True in [e in stderr for e in _TRANSIENT_ERRORS]
+
+
+def _run_with_retries(cmd, retries=0, backoff=1, timeout_e=None, logger=None):
+    attempt = 0
+    while True:
+        try:
+            return subprocess.run(cmd, shell=True, check=True, stderr=subprocess.PIPE)
+        except subprocess.CalledProcessError as e:
+            stderr = e.stderr.decode()
+            if attempt >= retries or not _is_transient_error(stderr):
+                raise
+            delay = backoff * 2 ** attempt
+            attempt += 1
+            if logger is not None:
+                logger.info(f'Transient error creating gpkg, retry {attempt} of {retries} in {delay}s: {stderr}')
+            if timeout_e is not None:
+                if timeout_e.wait(delay):
+                    raise
+            else:
+                time.sleep(delay)
+
+
 def _create_gpkg(data_id, bbox, layers, timeout_e=None, error_e=None, db_props=None, gpkg_path='', layers_path='',
-                 logfile='orka.log', loglevel='INFO'):
+                 layer_sqls=None, layer_srids=None, progress=None, retries=0, retry_backoff=1, profile=NO_PROFILE,
+                 explain_after=None, logfile='orka.log', loglevel='INFO'):
     log_handler = setup_file_logger(logfile=logfile)
     logger = logging.getLogger()
     logger.addHandler(log_handler)
     logger.setLevel(loglevel)
-    file_name = os.path.abspath(os.path.join(gpkg_path, data_id + '.gpkg'))
-    layer_sqls = _get_layer_sqls(layers_path, layer_names=layers)
+    file_name = get_gpkg_filename(gpkg_path, data_id, partial=True)
+    if layer_sqls is None:
+        layer_sqls = _get_layer_sqls(layers_path, layer_names=layers)
+    if progress is not None:
+        if not os.path.exists(file_name):
+            # the checkpoint is worthless without the staging file
+            progress.discard()
+        progress.start(list(layer_sqls.keys()))
     for layer_name, layer_sql in layer_sqls.items():
         if timeout_e is not None and timeout_e.isSet():
             break
-        gpkg_sql = _get_gpkg_sql(layer_sql, bbox)
+        if progress is not None and progress.is_done(layer_name):
+            logger.debug(f'Skipping layer {layer_name}, it is already exported.')
+            continue
+        srid, source_srid = (layer_srids or {}).get(layer_name, (25833, None))
+        # probed for each export, as the tables behind the layer may have changed since the last refresh of the stats
+        columns = _probe_layer_columns(db_props, layer_sql, layer_name, logger)
+        gpkg_sql = _get_gpkg_sql(layer_sql, bbox, srid=srid, source_srid=source_srid, columns=columns)
         gpkg_sql_escaped = _escape_sql(gpkg_sql)
         logger.debug(gpkg_sql_escaped)
-        cmd = _get_gpkg_cmd(file_name, layer_name, gpkg_sql_escaped, **db_props)
+        # without the columns of the layer, the geometry cannot be transformed in the query
+        cmd = _get_gpkg_cmd(file_name, layer_name, gpkg_sql_escaped, srid=srid, transform=columns is None, **db_props)
+        start = time.time()
+        size_before = _file_size(file_name)
+        with profile.span('ogr2ogr', layer=layer_name) as span:
+            try:
+                _run_with_retries(cmd, retries=retries, backoff=retry_backoff, timeout_e=timeout_e, logger=logger)
+            except subprocess.CalledProcessError as e:
+                logger.info(f'Error creating gpkg: {e.stderr.decode()}')
+                span.set(error='CalledProcessError')
+                if error_e is not None:
+                    error_e.set()
+                break
+        # the query runs a second time, so this is limited to slow layers
+        if profile.enabled and explain_after is not None and time.time() - start >= explain_after:
+            _explain_layer(db_props, gpkg_sql, layer_name, profile, logger)
+        if progress is not None:
+            progress.layer_done(layer_name,
+                                rows=_count_gpkg_rows(file_name, layer_name),
+                                size=_file_size(file_name) - size_before,
+                                seconds=time.time() - start)
+
+
+def _probe_layer_columns(db_props, layer_sql, layer_name, logger):
+    """Get the current columns of a layer, or None if they cannot be determined."""
+    try:
+        conn = psycopg2.connect(**db_props)
         try:
-            subprocess.run(cmd, shell=True, check=True, stderr=subprocess.PIPE)
-        except subprocess.CalledProcessError as e:
-            logger.info(f'Error creating gpkg: {e.stderr.decode()}')
-            if error_e is not None:
-                error_e.set()
-            break
+            return _get_query_columns(conn, layer_sql)
+        finally:
+            conn.close()
+    except psycopg2.Error as e:
+        logger.info(f'Could not get the columns of layer {layer_name}: {e}')
+        return None
+
+
+def _get_query_columns(conn, sql):
+    """Get the names of the columns of a query without fetching any rows."""
+    with conn.cursor() as cur:
+        cur.execute(f'SELECT * FROM ({sql}) AS l LIMIT 0')
+        columns = [d[0] for d in cur.description]
+    conn.rollback()
+    return columns
+
+
+def _explain_layer(db_props, gpkg_sql, layer_name, profile, logger):
+    """Add the query plan of a layer and the time PostGIS needs to execute its query to the profile."""
+    try:
+        with profile.span('explain', layer=layer_name):
+            conn = psycopg2.connect(**db_props)
+            try:
+                with conn.cursor() as cur:
+                    cur.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + gpkg_sql.replace('%', '%%'), {})
+                    plan = cur.fetchone()[0]
+                conn.rollback()
+            finally:
+                conn.close()
+    except psycopg2.Error as e:
+        logger.info(f'Could not explain layer {layer_name}: {e}')
+        return
+
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    profile.add_explain(layer_name, plan)
+    # the execution time without the transfer to and the writing by ogr2ogr
+    profile.add_span('query', time.time(), plan[0]['Execution Time'] / 1000, layer=layer_name,
+                     planning=plan[0]['Planning Time'] / 1000)
 
 
 def _escape_sql(sql):
@@ -68,17 +223,57 @@ def _get_layer_sqls(layers_path, layer_names=None):
     return layers
 
 
-def _get_gpkg_sql(layer_sql, bbox):
+def _get_gpkg_sql(layer_sql, bbox, srid=None, source_srid=None, columns=None):
     bbox_str = ', '.join([str(b) for b in bbox])
+    cols = '*'
+    if srid is not None and columns is not None:
+        geometry = 'l.geometry' if source_srid == srid else f'ST_Transform(l.geometry, {int(srid)}) AS geometry'
+        cols = ', '.join([geometry if c == 'geometry' else 'l.' + _quote_ident(c) for c in columns])
     # we use && (overlaps) instead of @> (contains), as we want to include all geometries that
     # in some way lie within the bbox
     # see https://www.postgresql.org/docs/9.1/functions-array.htm
-    return (f'SELECT * FROM ({layer_sql}) AS l '
+    return (f'SELECT {cols} FROM ({layer_sql}) AS l '
             f'WHERE l.geometry '
             f'&& ST_Transform(ST_MakeEnvelope({bbox_str}, 4326), ST_SRID(l.geometry))')
 
 
-def create_gpkg_threaded(app, job_id, *args, layers=None):
+def _quote_ident(ident):
+    return '"' + ident.replace('"', '""') + '"'
+
+
+def get_layer_srids(app, layer_sqls, srid=None, layer_srids=None):
+    """Get the target SRID and the source SRID of each layer.
+
+    The target SRID is taken from the job, then from ORKA_LAYER_SRIDS and then
+    from ORKA_DEFAULT_SRID. The source SRID is None until the layer statistics
+    are available.
+    """
+    layer_srids = layer_srids or {}
+    config_srids = app.config['ORKA_LAYER_SRIDS']
+    default_srid = app.config['ORKA_DEFAULT_SRID']
+
+    srids = {}
+    for layer_name in layer_sqls.keys():
+        target_srid = layer_srids.get(layer_name, srid)
+        if target_srid is None:
+            target_srid = config_srids.get(layer_name, default_srid)
+        stats = layer_registry.get_stats(layer_name) or {}
+        srids[layer_name] = (int(target_srid), stats.get('srid'))
+
+    return srids
+
+
+def get_gpkg_task(app, job_id, data_id, *args, layers=None, checkpoint=None, output_format=OutputFormat.GPKG,
+                  srid=None, layer_srids=None):
+    """Get target, args and kwargs of a thread that exports the data package of a job."""
+    profile = profiler.get_profile(job_id)
+    with profile.span('get_gpkg_task'):
+        return _get_gpkg_task(app, job_id, data_id, *args, layers=layers, checkpoint=checkpoint,
+                              output_format=output_format, srid=srid, layer_srids=layer_srids, profile=profile)
+
+
+def _get_gpkg_task(app, job_id, data_id, *args, layers=None, checkpoint=None, output_format=OutputFormat.GPKG,
+                   srid=None, layer_srids=None, profile=NO_PROFILE):
     db_props = {
         'host': app.config['PG_HOST'],
         'port': app.config['PG_PORT'],
@@ -87,56 +282,156 @@ def create_gpkg_threaded(app, job_id, *args, layers=None):
         'password': app.config['PG_PASSWORD']
     }
     gpkg_path = app.config['ORKA_GPKG_PATH']
-    layers_path = app.config['ORKA_LAYERS_PATH']
     timeout = app.config['ORKA_THREAD_TIMEOUT']
     logfile = app.config['ORKA_LOG_FILE']
     loglevel = app.config['ORKA_LOG_LEVEL']
     app_port = app.config['ORKA_APP_PORT']
+    progress_interval = app.config['ORKA_PROGRESS_INTERVAL']
+    retries = app.config['ORKA_LAYER_RETRIES']
+    retry_backoff = app.config['ORKA_LAYER_RETRY_BACKOFF']
+    heartbeat_interval = app.config['ORKA_HEARTBEAT_INTERVAL']
 
-    response_url = f'http://localhost:{app_port}/jobs/{job_id}'
+    # reported for the whole export, the job may be deleted before it ends
+    response_url = f'http://localhost:{app_port}/jobs/exports/{data_id}'
 
-    layers_abs_path = os.path.abspath(layers_path)
+    layer_sqls = layer_registry.get_sqls(layers)
 
-    thread = Thread(target=_create_gpkg_threaded,
-                    args=(response_url, *args, layers),
-                    kwargs={
-                        'timeout': timeout,
-                        'db_props': db_props,
-                        'gpkg_path': gpkg_path,
-                        'layers_path': layers_abs_path,
-                        'logfile': logfile,
-                        'loglevel': loglevel
-                    })
-    thread.start()
+    target_kwargs = {}
+    if app.config['ORKA_EXPORT_ENGINE'] == 'fake':
+        from orka_vector_api.helper.fake_helper import _create_fake_package
+        target = _create_fake_package
+        target_kwargs = {
+            'package_format': output_format,
+            'seconds_per_layer': app.config['ORKA_FAKE_LAYER_SECONDS'],
+            'rows_per_layer': app.config['ORKA_FAKE_LAYER_ROWS']
+        }
+    elif output_format == OutputFormat.MBTILES:
+        from orka_vector_api.helper.mbtiles_helper import _create_mbtiles
+        target = _create_mbtiles
+        style_path = app.config['ORKA_STYLE_PATH']
+        target_kwargs = {
+            'min_zoom': app.config['ORKA_MBTILES_MIN_ZOOM'],
+            'max_zoom': app.config['ORKA_MBTILES_MAX_ZOOM'],
+            'workers': app.config['ORKA_MBTILES_WORKERS'],
+            'batch_size': app.config['ORKA_MBTILES_BATCH_SIZE'],
+            'groups_file': os.path.abspath(os.path.join(style_path, app.config['ORKA_LAYER_GROUPS_FILE']))
+        }
+    else:
+        target = _create_gpkg
+        # vector tiles are always in EPSG:3857, only geopackages are reprojected
+        target_kwargs = {
+            'layer_srids': get_layer_srids(app, layer_sqls, srid=srid, layer_srids=layer_srids),
+            'explain_after': profiler.explain_after
+        }
+
+    kwargs = {
+        'target': target,
+        'output_format': output_format,
+        'timeout': timeout,
+        'heartbeat_interval': heartbeat_interval,
+        'progress_interval': progress_interval,
+        'checkpoint': checkpoint,
+        'retries': retries,
+        'retry_backoff': retry_backoff,
+        'db_props': db_props,
+        'gpkg_path': gpkg_path,
+        'layer_sqls': layer_sqls,
+        'logfile': logfile,
+        'loglevel': loglevel,
+        'profile': profile,
+        'stack_interval': profiler.stack_interval,
+        'queued_at': time.time(),
+        **target_kwargs
+    }
+    return _create_gpkg_threaded, (response_url, data_id, *args, layers), kwargs
 
 
-def _create_gpkg_threaded(response_url, *args, timeout=None, logfile='orka.log', loglevel='INFO', **kwargs):
+def _create_gpkg_threaded(response_url, data_id, *args, target=_create_gpkg, output_format=OutputFormat.GPKG,
+                          timeout=None, heartbeat_interval=None, progress_interval=5, checkpoint=None,
+                          profile=NO_PROFILE, stack_interval=None, queued_at=None, logfile='orka.log', loglevel='INFO',
+                          **kwargs):
+    with _live_exports_lock:
+        _live_exports.add(data_id)
+    if queued_at is not None:
+        profile.add_span('queue_wait', queued_at, time.time() - queued_at)
+    progress = ProgressReporter(response_url, interval=progress_interval, checkpoint=checkpoint, profile=profile)
     try:
+        # the job may have been queued before
+        _put_status(response_url, profile, status=Status.RUNNING.value)
         timeout_e = Event()
         error_e = Event()
-        thread = Thread(target=_create_gpkg, args=args,
-                        kwargs={'timeout_e': timeout_e, 'error_e': error_e, 'logfile': logfile, 'loglevel': loglevel,
-                                **kwargs})
-        thread.start()
-
-        killed = False
-        if timeout is not None:
-            thread.join(timeout)
-            if thread.is_alive():
-                killed = True
-            timeout_e.set()
-        thread.join()
+        thread = Thread(target=target, args=(data_id, *args),
+                        kwargs={'timeout_e': timeout_e, 'error_e': error_e, 'progress': progress, 'logfile': logfile,
+                                'loglevel': loglevel, 'profile': profile, **kwargs})
+        with profile.span('export', format=output_format.value):
+            thread.start()
+            stop_sampling_e = profile.sample_stacks(thread, stack_interval) if stack_interval else None
+
+            killed = _watch(thread, timeout_e, timeout=timeout, heartbeat_interval=heartbeat_interval,
+                            heartbeat=lambda: _put_heartbeat(response_url))
+            if stop_sampling_e is not None:
+                stop_sampling_e.set()
 
         if error_e.isSet():
-            return put(response_url, json={'status': Status.ERROR.value})
+            return _put_status(response_url, profile, status=Status.ERROR.value, progress=progress.to_json())
         if killed or error_e.isSet():
-            return put(response_url, json={'status': Status.TIMEOUT.value})
+            return _put_status(response_url, profile, status=Status.TIMEOUT.value, progress=progress.to_json())
         else:
-            return put(response_url, json={'status': Status.CREATED.value})
+            gpkg_path = kwargs.get('gpkg_path', '')
+            partial_file_name = get_gpkg_filename(gpkg_path, data_id, partial=True, output_format=output_format)
+            if os.path.exists(partial_file_name):
+                os.replace(partial_file_name, get_gpkg_filename(gpkg_path, data_id, output_format=output_format))
+            return _put_status(response_url, profile, status=Status.CREATED.value, progress=progress.to_json())
     except Exception as e:
         log_handler = setup_file_logger(logfile=logfile)
         logger = logging.getLogger()
         logger.addHandler(log_handler)
         logger.setLevel(loglevel)
         logger.info(f'Unexpected Error: {e}')
-        return put(response_url, json={'status': Status.ERROR.value})
+        return _put_status(response_url, profile, status=Status.ERROR.value, progress=progress.to_json())
+    finally:
+        with _live_exports_lock:
+            _live_exports.discard(data_id)
+
+
+def get_live_exports():
+    """Get the data ids of the exports that have a running thread in this process."""
+    with _live_exports_lock:
+        return list(_live_exports)
+
+
+def _watch(thread, timeout_e, timeout=None, heartbeat_interval=None, heartbeat=None):
+    """Wait for the export thread, signal its timeout and send a heartbeat every `heartbeat_interval` seconds.
+
+    Returns True if the thread was still running when the timeout was reached.
+    """
+    killed = False
+    deadline = time.time() + timeout if timeout is not None else None
+    next_heartbeat = time.time() + heartbeat_interval if heartbeat_interval else None
+    while thread.is_alive():
+        now = time.time()
+        if deadline is not None and not killed and now >= deadline:
+            killed = True
+            timeout_e.set()
+        if next_heartbeat is not None and now >= next_heartbeat:
+            heartbeat()
+            next_heartbeat = now + heartbeat_interval
+        # the heartbeat continues while a killed export shuts down
+        wakeups = [t for t in [None if killed else deadline, next_heartbeat] if t is not None]
+        thread.join(max(min(wakeups) - time.time(), 0) if len(wakeups) > 0 else None)
+    if timeout is not None:
+        timeout_e.set()
+    return killed
+
+
+def _put_status(response_url, profile, **job):
+    with profile.span('status_callback', status=job.get('status')):
+        return put(response_url, json=job)
+
+
+def _put_heartbeat(response_url):
+    """Touch the jobs of the export, so the reaper does not consider them crashed while a layer takes long."""
+    try:
+        put(response_url, json={})
+    except Exception as e:
+        logging.getLogger().info(f'Could not send heartbeat: {e}')
@@ -1,12 +1,23 @@
+import hashlib
+import json
 import os
 
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
 from psycopg2.sql import SQL, Identifier, Composed, Placeholder
 
-from orka_vector_api.enums import Status
+from orka_vector_api.enums import Status, OutputFormat
+from orka_vector_api.helper.gdal_helper import get_output_filenames
 
+# the columns of a job as returned by get_job_by_id
+_JOB_COLUMNS = ['id', 'minx', 'miny', 'maxx', 'maxy', 'data_id', 'status', 'layers', 'progress', 'format', 'srid',
+                'layer_srids']
 
-def create_job(conn, app, bbox, data_id, layers=None):
+
+def create_job(conn, app, bbox, data_id, layers=None, output_format=OutputFormat.GPKG, status=Status.INIT,
+               idempotency_key=None, request_key=None, srid=None, layer_srids=None):
+    """Create a job and return its id.
+    If `status` is None, the job copies the status of the jobs it shares the export
+    of `data_id` with, read by the same statement that inserts it."""
     schema = app.config['ORKA_DB_SCHEMA']
     if not _is_sane_schema(schema):
         raise Exception('Schema is not sane.')
@@ -16,23 +27,40 @@ def create_job(conn, app, bbox, data_id, layers=None):
         'miny': float(bbox[1]),
         'maxx': float(bbox[2]),
         'maxy': float(bbox[3]),
-        'status': Status.INIT.value,
+        'status': status.value if status is not None else None,
         'data_id': data_id,
-        'layers': None
+        'layers': None,
+        'format': output_format.value,
+        'idempotency_key': idempotency_key,
+        'request_key': request_key,
+        'srid': srid,
+        'layer_srids': None
     }
 
     if layers is not None:
         props['layers'] = ','.join(layers)
 
+    if layer_srids is not None and len(layer_srids) > 0:
+        props['layer_srids'] = json.dumps(layer_srids)
+
     if False in [_is_sane(k, v) for k, v in props.items()]:
         raise Exception('Properties are not sane.')
 
-    q = SQL('INSERT INTO {}.{} (minx, miny, maxx, maxy, status, data_id, layers) '
-            'VALUES (%(minx)s, %(miny)s, %(maxx)s, %(maxy)s, %(status)s, %(data_id)s, %(layers)s) '
-            'RETURNING id;').format(Identifier(schema), Identifier('jobs'))
+    if status is not None:
+        status_value = SQL('%(status)s')
+    else:
+        # the export may have failed or finished since it was looked up
+        status_value = SQL('COALESCE((SELECT status FROM {}.{} WHERE data_id = %(data_id)s '
+                           'ORDER BY updated_at DESC LIMIT 1), %(error)s)').format(Identifier(schema),
+                                                                                   Identifier('jobs'))
+    q = SQL('INSERT INTO {}.{} (minx, miny, maxx, maxy, status, data_id, layers, format, idempotency_key, request_key, '
+            'srid, layer_srids) '
+            'VALUES (%(minx)s, %(miny)s, %(maxx)s, %(maxy)s, {}, %(data_id)s, %(layers)s, %(format)s, '
+            '%(idempotency_key)s, %(request_key)s, %(srid)s, %(layer_srids)s) '
+            'RETURNING id;').format(Identifier(schema), Identifier('jobs'), status_value)
 
     with conn.cursor() as cur:
-        cur.execute(q, {'schema': schema, **props})
+        cur.execute(q, {'schema': schema, 'error': Status.ERROR.value, **props})
         job_id, = cur.fetchone()
         conn.commit()
 
@@ -48,6 +76,7 @@ def update_job(job_id, conn, app, **kwargs):
         raise Exception("Attributes are not sane.")
 
     vals = [Composed([Identifier(k), SQL('='), Placeholder(k)]) for k in kwargs.keys() if k != 'id']
+    vals.append(SQL('updated_at=now()'))
     q = SQL('UPDATE {schema}.{table} SET {data} WHERE id = %(job_id)s;').format(
         schema=Identifier(schema),
         table=Identifier('jobs'),
@@ -67,16 +96,67 @@ def update_job(job_id, conn, app, **kwargs):
         conn.commit()
 
 
+def update_jobs_by_dataid(data_id, conn, app, **kwargs):
+    """Update all jobs that share the export of given data_id. Returns the number of updated jobs."""
+    schema = app.config['ORKA_DB_SCHEMA']
+    if not _is_sane_schema(schema):
+        raise Exception('Schema is not sane.')
+
+    if False in [_is_sane(k, v) for k, v in kwargs.items() if k not in ['id', 'data_id']]:
+        raise Exception("Attributes are not sane.")
+
+    vals = [Composed([Identifier(k), SQL('='), Placeholder(k)]) for k in kwargs.keys() if k not in ['id', 'data_id']]
+    vals.append(SQL('updated_at=now()'))
+    q = SQL('UPDATE {schema}.{table} SET {data} WHERE data_id = %(where_data_id)s;').format(
+        schema=Identifier(schema),
+        table=Identifier('jobs'),
+        data=SQL(',').join(vals)
+    )
+
+    with conn.cursor() as cur:
+        cur.execute(q, {
+            **kwargs,
+            'where_data_id': data_id
+        })
+        updated_rows = cur.rowcount
+        conn.commit()
+
+    return updated_rows
+
+
+def transition_jobs_by_dataid(data_id, conn, app, from_statuses, status):
+    """Set the status of all jobs of given data_id, if they have one of `from_statuses`.
+
+    The check and the update are a single statement, so concurrent callers
+    cannot both succeed. Returns the number of updated jobs.
+    """
+    schema = app.config['ORKA_DB_SCHEMA']
+    if not _is_sane_schema(schema):
+        raise Exception('Schema is not sane.')
+
+    q = SQL('UPDATE {schema}.{table} SET status = %(status)s, updated_at = now() '
+            'WHERE data_id = %(data_id)s AND status = ANY(%(from_statuses)s);').format(
+        schema=Identifier(schema),
+        table=Identifier('jobs')
+    )
+
+    with conn.cursor() as cur:
+        cur.execute(q, {'status': status, 'data_id': data_id, 'from_statuses': list(from_statuses)})
+        count = cur.rowcount
+        conn.commit()
+
+    return count
+
+
 def get_job_by_id(job_id, conn, app):
     schema = app.config['ORKA_DB_SCHEMA']
     if not _is_sane_schema(schema):
         raise Exception('Schema is not sane.')
 
-    cols = ['id', 'minx', 'miny', 'maxx', 'maxy', 'data_id', 'status', 'layers']
     q = SQL('SELECT {cols} '
             'FROM {schema}.{table} '
             'WHERE id = %(job_id)s;').format(
-        cols=SQL(',').join([Identifier(k) for k in cols]),
+        cols=SQL(',').join([Identifier(k) for k in _JOB_COLUMNS]),
         schema=Identifier(schema),
         table=Identifier('jobs'))
 
@@ -84,8 +164,90 @@ def get_job_by_id(job_id, conn, app):
         cur.execute(q, {'job_id': job_id})
         job = cur.fetchone()
 
+    return _parse_job(job)
+
+
+def _parse_job(job):
+    if job is None:
+        return None
     if job['layers'] is not None:
         job['layers'] = job['layers'].split(',')
+    if job['progress'] is not None:
+        job['progress'] = json.loads(job['progress'])
+    if job['format'] is None:
+        job['format'] = OutputFormat.GPKG.value
+    if job['layer_srids'] is not None:
+        job['layer_srids'] = json.loads(job['layer_srids'])
+    return job
+
+
+def get_request_key(bbox, layers=None, output_format=OutputFormat.GPKG, srid=None, layer_srids=None):
+    """Get a key that is equal for all requests of the same data package.
+
+    The bbox is rounded to about 10 cm and the order of the layers is ignored.
+    """
+    normalized = {
+        'bbox': [round(float(b), 6) for b in bbox],
+        'layers': sorted(set(layers)) if layers is not None else None,
+        'format': output_format.value,
+        'srid': srid,
+        'layer_srids': layer_srids or None
+    }
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def lock_request_key(conn, request_key):
+    """Serialize the submissions of the same request until the current transaction ends."""
+    with conn.cursor() as cur:
+        cur.execute('SELECT pg_advisory_xact_lock(%(key)s);', {'key': int(request_key[:15], 16)})
+
+
+def lock_data_id(conn, data_id):
+    """Serialize jobs attaching to the export of given data_id with its status updates
+    until the current transaction ends."""
+    with conn.cursor() as cur:
+        cur.execute('SELECT pg_advisory_xact_lock(hashtext(%(key)s));', {'key': data_id})
+
+
+def get_inflight_job(conn, app, request_key):
+    """Get a queued or running job of the same request, whose export a new job can attach to."""
+    schema = app.config['ORKA_DB_SCHEMA']
+    if not _is_sane_schema(schema):
+        raise Exception('Schema is not sane.')
+
+    q = SQL('SELECT {cols} FROM {schema}.{table} '
+            'WHERE request_key = %(request_key)s AND status IN (%(queued)s, %(running)s) '
+            'ORDER BY id LIMIT 1;').format(
+        cols=SQL(',').join([Identifier(k) for k in _JOB_COLUMNS]),
+        schema=Identifier(schema),
+        table=Identifier('jobs'))
+
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(q, {
+            'request_key': request_key,
+            'queued': Status.QUEUED.value,
+            'running': Status.RUNNING.value
+        })
+        job = cur.fetchone()
+
+    return _parse_job(job)
+
+
+def get_job_by_idempotency_key(conn, app, idempotency_key):
+    """Get id and request key of the job that was created with given idempotency key."""
+    schema = app.config['ORKA_DB_SCHEMA']
+    if not _is_sane_schema(schema):
+        raise Exception('Schema is not sane.')
+
+    q = SQL('SELECT id, request_key FROM {schema}.{table} WHERE idempotency_key = %(idempotency_key)s;').format(
+        schema=Identifier(schema),
+        table=Identifier('jobs'))
+
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(q, {'idempotency_key': idempotency_key})
+        job = cur.fetchone()
+        conn.commit()
+
     return job
 
 
@@ -128,38 +290,17 @@ def delete_job_by_id(job_id, conn, app):
 
 
 def delete_geopackage(data_id, conn, app):
-    gpkg_path = app.config['ORKA_GPKG_PATH']
-    filename = data_id + '.gpkg'
-    filepath = os.path.join(gpkg_path, filename)
-    if os.path.exists(filepath):
-        os.remove(filepath)
-        return True
-    else:
+    # jobs attached to the same export share the files
+    if get_job_id_by_dataid(data_id, conn, app) is not None:
         return False
 
-
-def count_running_jobs(conn, app):
-    schema = app.config['ORKA_DB_SCHEMA']
-    q = SQL('SELECT count(*) FROM {schema}.{table} WHERE status = %(status)s;').format(
-        schema=Identifier(schema),
-        table=Identifier('jobs')
-    )
-
-    with conn.cursor() as cur:
-        cur.execute(q, {'status': Status.RUNNING.value})
-        count = cur.fetchone()[0]
-        conn.commit()
-
-    return count
-
-
-def threads_available(conn, app):
-    max_threads = app.config['ORKA_MAX_THREADS']
-    running_jobs = count_running_jobs(conn, app)
-    # we have a watchdog for each thread, so we have to double it
-    running_threads = running_jobs * 2
-    free_threads = max_threads - running_threads
-    return free_threads >= 2
+    gpkg_path = app.config['ORKA_GPKG_PATH']
+    deleted = False
+    for filepath in get_output_filenames(gpkg_path, data_id):
+        if os.path.exists(filepath):
+            os.remove(filepath)
+            deleted = True
+    return deleted
 
 
 def bbox_size_allowed(conn, app, bbox):
@@ -181,6 +322,60 @@ def bbox_size_allowed(conn, app, bbox):
     return area <= max_area
 
 
+def srids_exist(conn, srids):
+    q = 'SELECT count(*) FROM spatial_ref_sys WHERE srid = ANY(%(srids)s);'
+    srids = list(set(srids))
+    with conn.cursor() as cur:
+        cur.execute(q, {'srids': srids})
+        count = cur.fetchone()[0]
+    return count == len(srids)
+
+
+def get_layer_stats(conn, app, layers):
+    schema = app.config['ORKA_DB_SCHEMA']
+    if not _is_sane_schema(schema):
+        raise Exception('Schema is not sane.')
+
+    q = SQL('SELECT layer, seconds FROM {schema}.{table} WHERE layer = ANY(%(layers)s);').format(
+        schema=Identifier(schema),
+        table=Identifier('layer_stats')
+    )
+
+    with conn.cursor() as cur:
+        cur.execute(q, {'layers': list(layers)})
+        stats = {layer: seconds for layer, seconds in cur.fetchall()}
+
+    return stats
+
+
+def update_layer_stats(conn, app, progress):
+    """Merge the per-layer durations of a finished export into the running means.
+    Layers taken over from the checkpoint of a failed run are skipped, they were merged before or never finished."""
+    schema = app.config['ORKA_DB_SCHEMA']
+    if not _is_sane_schema(schema):
+        raise Exception('Schema is not sane.')
+
+    values = [(layer, 1, p['seconds'], p['rows'] or 0, p['bytes'] or 0)
+              for layer, p in progress.get('layers', {}).items()
+              if p.get('seconds') is not None and not p.get('resumed', False)]
+    if len(values) == 0:
+        return
+
+    q = SQL('INSERT INTO {schema}.{table} AS t (layer, samples, seconds, rows, bytes) VALUES %s '
+            'ON CONFLICT (layer) DO UPDATE SET '
+            'samples = t.samples + 1, '
+            'seconds = t.seconds + (EXCLUDED.seconds - t.seconds) / (t.samples + 1), '
+            'rows = t.rows + (EXCLUDED.rows - t.rows) / (t.samples + 1), '
+            'bytes = t.bytes + (EXCLUDED.bytes - t.bytes) / (t.samples + 1);').format(
+        schema=Identifier(schema),
+        table=Identifier('layer_stats')
+    )
+
+    with conn.cursor() as cur:
+        execute_values(cur, q.as_string(conn), values)
+        conn.commit()
+
+
 def _is_sane(key, val):
     prop_map = {
         'minx': float,
@@ -189,7 +384,13 @@ def _is_sane(key, val):
         'maxy': float,
         'status': str,
         'data_id': str,
-        'layers': str
+        'layers': str,
+        'progress': str,
+        'format': str,
+        'idempotency_key': str,
+        'request_key': str,
+        'srid': int,
+        'layer_srids': str
     }
 
     if not isinstance(key, str):
@@ -0,0 +1,253 @@
+import gzip
+import json
+import logging
+import math
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import local, Lock
+
+import psycopg2
+
+from orka_vector_api import setup_file_logger
+from orka_vector_api.enums import OutputFormat
+from orka_vector_api.helper.gdal_helper import get_gpkg_filename, _get_layer_sqls, _get_query_columns, \
+    _is_transient_error
+from orka_vector_api.profiler import NO_PROFILE
+
+# half the circumference of the earth in EPSG:3857
+_WEB_MERCATOR_EXTENT = 20037508.342789244
+_MAX_LATITUDE = 85.0511287798
+_TILE_EXTENT = 4096
+_TILE_BUFFER = 64
+
+
+def _create_mbtiles(data_id, bbox, layers, timeout_e=None, error_e=None, db_props=None, gpkg_path='', layers_path='',
+                    layer_sqls=None, progress=None, retries=0, retry_backoff=1, min_zoom=0, max_zoom=14, workers=4,
+                    batch_size=256, groups_file=None, profile=NO_PROFILE, logfile='orka.log', loglevel='INFO'):
+    """Create an MBTiles package with vector tiles of all layers for the zoom levels covering the bbox.
+
+    The tiles are rendered in parallel by PostGIS and written in batches. Each zoom
+    level is reported as one step of the progress, so a resumed job only renders
+    the zoom levels that are missing.
+    """
+    log_handler = setup_file_logger(logfile=logfile)
+    logger = logging.getLogger()
+    logger.addHandler(log_handler)
+    logger.setLevel(loglevel)
+    file_name = get_gpkg_filename(gpkg_path, data_id, partial=True, output_format=OutputFormat.MBTILES)
+    if layer_sqls is None:
+        layer_sqls = _get_layer_sqls(layers_path, layer_names=layers)
+    zoom_levels = list(range(min_zoom, max_zoom + 1))
+    if progress is not None:
+        if not os.path.exists(file_name):
+            progress.discard()
+        progress.start([_get_step_name(z) for z in zoom_levels])
+
+    connections = _ConnectionPool(db_props)
+    mbtiles = sqlite3.connect(file_name)
+    try:
+        layer_columns = {name: _get_layer_columns(connections.get(), sql) for name, sql in layer_sqls.items()}
+        tile_sql = _get_tile_sql(layer_sqls, layer_columns, bbox)
+        logger.debug(tile_sql)
+        _init_mbtiles(mbtiles, data_id, bbox, min_zoom, max_zoom, layer_columns, groups_file)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for zoom in zoom_levels:
+                step_name = _get_step_name(zoom)
+                if progress is not None and progress.is_done(step_name):
+                    logger.debug(f'Skipping zoom level {zoom}, it is already rendered.')
+                    continue
+                start = time.time()
+                tiles = list(_get_tiles(bbox, zoom))
+                batches = [tiles[i:i + batch_size] for i in range(0, len(tiles), batch_size)]
+                futures = [executor.submit(_render_tiles, connections, tile_sql, zoom, batch, retries, retry_backoff,
+                                           timeout_e) for batch in batches]
+                written = 0
+                size = 0
+                for future in futures:
+                    if timeout_e is not None and timeout_e.isSet():
+                        for f in futures:
+                            f.cancel()
+                        return
+                    rendered = future.result()
+                    mbtiles.executemany('INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) '
+                                        'VALUES (?, ?, ?, ?);', rendered)
+                    mbtiles.commit()
+                    written += len(rendered)
+                    size += sum([len(r[3]) for r in rendered])
+                profile.add_span('zoom', start, time.time() - start, zoom=zoom, tiles=written, bytes=size)
+                if progress is not None:
+                    progress.layer_done(step_name, rows=written, size=size, seconds=time.time() - start)
+    except Exception as e:
+        logger.info(f'Error creating mbtiles: {e}')
+        if error_e is not None:
+            error_e.set()
+    finally:
+        mbtiles.close()
+        connections.close()
+
+
+def _get_step_name(zoom):
+    return f'z{zoom}'
+
+
+def _render_tiles(connections, tile_sql, zoom, tiles, retries, retry_backoff, timeout_e):
+    """Render a batch of tiles and return the rows to insert into the tiles table."""
+    attempt = 0
+    while True:
+        try:
+            conn = connections.get()
+            rendered = []
+            with conn.cursor() as cur:
+                for x, y in tiles:
+                    if timeout_e is not None and timeout_e.isSet():
+                        return rendered
+                    cur.execute(tile_sql % _get_tile_envelope(x, y, zoom))
+                    tile, = cur.fetchone()
+                    if tile is None or len(tile) == 0:
+                        continue
+                    # mbtiles uses the TMS scheme with the origin at the bottom left
+                    rendered.append((zoom, x, 2 ** zoom - 1 - y, gzip.compress(bytes(tile))))
+            conn.rollback()
+            return rendered
+        except psycopg2.OperationalError as e:
+            connections.discard()
+            if attempt >= retries or not _is_transient_error(str(e)):
+                raise
+            time.sleep(retry_backoff * 2 ** attempt)
+            attempt += 1
+
+
+def _get_tiles(bbox, zoom):
+    min_x, min_y = _lonlat_to_tile(bbox[0], bbox[3], zoom)
+    max_x, max_y = _lonlat_to_tile(bbox[2], bbox[1], zoom)
+    for x in range(min_x, max_x + 1):
+        for y in range(min_y, max_y + 1):
+            yield x, y
+
+
+def _lonlat_to_tile(lon, lat, zoom):
+    n = 2 ** zoom
+    lat = max(min(float(lat), _MAX_LATITUDE), -_MAX_LATITUDE)
+    x = int((float(lon) + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def _get_tile_envelope(x, y, zoom):
+    size = 2 * _WEB_MERCATOR_EXTENT / 2 ** zoom
+    min_x = -_WEB_MERCATOR_EXTENT + x * size
+    max_y = _WEB_MERCATOR_EXTENT - y * size
+    return {
+        'minx': repr(min_x),
+        'miny': repr(max_y - size),
+        'maxx': repr(min_x + size),
+        'maxy': repr(max_y)
+    }
+
+
+def _get_layer_columns(conn, layer_sql):
+    return [c for c in _get_query_columns(conn, layer_sql) if c != 'geometry']
+
+
+def _get_tile_sql(layer_sqls, layer_columns, bbox):
+    # the layer sqls may contain % characters, so the tile envelope is
+    # substituted with python string formatting and not as query parameter
+    layer_sqls = {name: sql.replace('%', '%%') for name, sql in layer_sqls.items()}
+    bbox_str = ', '.join([repr(float(b)) for b in bbox])
+    # web mercator is undefined beyond the maximum latitude
+    clip_bbox = [float(bbox[0]), max(float(bbox[1]), -_MAX_LATITUDE),
+                 float(bbox[2]), min(float(bbox[3]), _MAX_LATITUDE)]
+    clip_bbox_str = ', '.join([repr(b) for b in clip_bbox])
+    parts = []
+    for layer_name, layer_sql in layer_sqls.items():
+        cols = ''.join([', l.' + _quote_ident(c) for c in layer_columns[layer_name]]).replace('%', '%%')
+        name = _quote_literal(layer_name).replace('%', '%%')
+        parts.append(f"(SELECT COALESCE(ST_AsMVT(t, {name}, {_TILE_EXTENT}, 'mvtgeom'), '') FROM ("
+                     f'SELECT ST_AsMVTGeom(ST_Transform(l.geometry, 3857), e.geom, '
+                     f'{_TILE_EXTENT}, {_TILE_BUFFER}, true) AS mvtgeom{cols} '
+                     f'FROM ({layer_sql}) AS l, e '
+                     # like a geopackage, the package only contains the features of the bbox
+                     f'WHERE l.geometry && ST_Transform(ST_MakeEnvelope({bbox_str}, 4326), ST_SRID(l.geometry)) '
+                     f'AND l.geometry && ST_Transform(e.clip, ST_SRID(l.geometry))) AS t)')
+
+    # the buffered tile is clipped to the bbox, so even the tiles of the lowest zoom levels
+    # only cover an area that can be transformed to the srid of any layer
+    return (f'WITH e AS (SELECT geom, ST_Intersection('
+            f'ST_Expand(geom, (ST_XMax(geom) - ST_XMin(geom)) * {_TILE_BUFFER / _TILE_EXTENT}), '
+            f'ST_Transform(ST_MakeEnvelope({clip_bbox_str}, 4326), 3857)) AS clip '
+            'FROM (SELECT ST_MakeEnvelope(%(minx)s, %(miny)s, %(maxx)s, %(maxy)s, 3857) AS geom) AS g) '
+            'SELECT ' + ' || '.join(parts))
+
+
+def _init_mbtiles(mbtiles, data_id, bbox, min_zoom, max_zoom, layer_columns, groups_file):
+    mbtiles.execute('CREATE TABLE IF NOT EXISTS metadata (name text PRIMARY KEY, value text);')
+    mbtiles.execute('CREATE TABLE IF NOT EXISTS tiles '
+                    '(zoom_level integer, tile_column integer, tile_row integer, tile_data blob);')
+    mbtiles.execute('CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row);')
+
+    vector_layers = [{
+        'id': name,
+        'fields': {c: 'String' for c in columns},
+        'minzoom': min_zoom,
+        'maxzoom': max_zoom
+    } for name, columns in layer_columns.items()]
+    metadata = {
+        'name': data_id,
+        'format': 'pbf',
+        'type': 'overlay',
+        'bounds': ','.join([str(float(b)) for b in bbox]),
+        'center': f'{(float(bbox[0]) + float(bbox[2])) / 2},{(float(bbox[1]) + float(bbox[3])) / 2},{min_zoom}',
+        'minzoom': str(min_zoom),
+        'maxzoom': str(max_zoom),
+        'json': json.dumps({'vector_layers': vector_layers})
+    }
+    # the layer groups are stored alongside, so clients can build their layer tree without another request
+    if groups_file is not None and os.path.isfile(groups_file):
+        with open(groups_file) as f:
+            metadata['orka_layer_groups'] = f.read()
+
+    mbtiles.executemany('INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?);', metadata.items())
+    mbtiles.commit()
+
+
+def _quote_ident(ident):
+    return '"' + ident.replace('"', '""') + '"'
+
+
+def _quote_literal(literal):
+    return "'" + literal.replace("'", "''") + "'"
+
+
+class _ConnectionPool(object):
+    """Hands out one connection to the vector database per rendering thread."""
+
+    def __init__(self, db_props):
+        self.db_props = db_props
+        self.local = local()
+        self.connections = []
+        self.lock = Lock()
+
+    def get(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or conn.closed:
+            conn = psycopg2.connect(**self.db_props)
+            self.local.conn = conn
+            with self.lock:
+                self.connections.append(conn)
+        return conn
+
+    def discard(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None and not conn.closed:
+            conn.close()
+        self.local.conn = None
+
+    def close(self):
+        with self.lock:
+            for conn in self.connections:
+                if not conn.closed:
+                    conn.close()
+            self.connections = []
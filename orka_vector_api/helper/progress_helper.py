@@ -0,0 +1,137 @@
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from requests import put
+
+from orka_vector_api.profiler import NO_PROFILE
+
+
+class ProgressReporter(object):
+    """Collects the per-layer progress of an export and reports it to the job.
+
+    Progress is sent to the job resource at most once every `interval` seconds,
+    so fast layers do not cause a database write each. The final state is sent
+    together with the final status of the job.
+
+    The reported progress doubles as checkpoint: a resumed export is initialized
+    with the progress of the failed run and skips the layers that are done.
+    """
+
+    def __init__(self, response_url, interval=5, checkpoint=None, profile=NO_PROFILE):
+        self.response_url = response_url
+        self.interval = interval
+        self.profile = profile
+        self.started = time.time()
+        self.last_report = self.started
+        self.pending = []
+        self.layers = {}
+        self.elapsed_before = 0
+        if checkpoint is not None:
+            # flagged, so their durations are not recorded as layer stats a second time
+            self.layers = {k: {**v, 'resumed': True} for k, v in checkpoint.get('layers', {}).items()}
+            self.elapsed_before = checkpoint.get('elapsed', 0)
+
+    def start(self, layer_names):
+        self.pending = [n for n in layer_names if n not in self.layers]
+
+    def discard(self):
+        self.layers = {}
+        self.elapsed_before = 0
+
+    def is_done(self, layer_name):
+        return layer_name in self.layers
+
+    def layer_done(self, layer_name, rows=None, size=None, seconds=None):
+        if layer_name in self.pending:
+            self.pending.remove(layer_name)
+        self.layers[layer_name] = {
+            'rows': rows,
+            'bytes': size,
+            'seconds': round(seconds, 3) if seconds is not None else None
+        }
+        self.report()
+
+    def to_dict(self):
+        now = time.time()
+        return {
+            'layers_total': len(self.layers) + len(self.pending),
+            'layers_done': len(self.layers),
+            'elapsed': round(self.elapsed_before + now - self.started, 1),
+            'updated': now,
+            'pending': list(self.pending),
+            'layers': self.layers
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+    def report(self, force=False):
+        now = time.time()
+        if not force and now - self.last_report < self.interval:
+            return
+        self.last_report = now
+        try:
+            with self.profile.span('progress_callback'):
+                put(self.response_url, json={'progress': self.to_json()})
+        except Exception as e:
+            logging.getLogger().info(f'Could not report progress: {e}')
+
+
+def get_eta_layers(progress):
+    """Get the layers whose historical durations `estimate_eta` needs, the done as well as the pending ones."""
+    if progress is None:
+        return []
+    return list(progress.get('layers', {}).keys()) + list(progress.get('pending', []))
+
+
+def estimate_eta(progress, layer_stats):
+    """Estimate the remaining seconds of a running export.
+
+    `layer_stats` maps layer names to their historical mean duration in seconds.
+    The historical durations of the pending layers are scaled by the ratio of
+    actual to historical duration of the layers that are already done.
+    """
+    if progress is None:
+        return None
+    pending = progress.get('pending', [])
+    if len(pending) == 0:
+        return 0
+
+    done = {k: v for k, v in progress.get('layers', {}).items() if v.get('seconds') is not None}
+    expected = sum([layer_stats[k] for k in done if k in layer_stats])
+    actual = sum([v['seconds'] for k, v in done.items() if k in layer_stats])
+    scale = actual / expected if expected > 0 and actual > 0 else 1.0
+
+    known = [layer_stats[k] for k in pending if k in layer_stats]
+    if len(known) > 0:
+        fallback = sum(known) / len(known)
+    elif len(done) > 0:
+        fallback = sum([v['seconds'] for v in done.values()]) / len(done)
+    else:
+        return None
+
+    eta = sum([layer_stats.get(k, fallback) for k in pending]) * scale
+    since_update = time.time() - progress.get('updated', time.time())
+    return round(max(eta - since_update, 0), 1)
+
+
+def _count_gpkg_rows(file_name, layer_name):
+    if not os.path.exists(file_name):
+        return None
+    table = layer_name.replace('"', '""')
+    conn = sqlite3.connect(file_name)
+    try:
+        return conn.execute(f'SELECT count(*) FROM "{table}"').fetchone()[0]
+    except sqlite3.Error:
+        return None
+    finally:
+        conn.close()
+
+
+def _file_size(file_name):
+    if not os.path.exists(file_name):
+        return 0
+    return os.path.getsize(file_name)
@@ -0,0 +1,335 @@
+import os
+import time
+import uuid
+from threading import Thread
+
+from psycopg2.sql import SQL, Identifier
+
+from orka_vector_api import db, scheduler
+from orka_vector_api.enums import Status, OutputFormat
+from orka_vector_api.helper.gdal_helper import get_output_filenames, get_live_exports
+from orka_vector_api.helper.job_helper import _is_sane_schema
+
+# arbitrary key of the advisory lock that ensures only one reaper runs at a time
+_REAPER_LOCK_KEY = 7305526
+
+
+def start_reaper(app):
+    interval = app.config['ORKA_REAPER_INTERVAL']
+    if not interval:
+        return None
+
+    heartbeat_interval = app.config['ORKA_HEARTBEAT_INTERVAL']
+    stale_after = get_stale_after(app)
+    if heartbeat_interval and stale_after is not None and stale_after <= heartbeat_interval:
+        raise ValueError(f'ORKA_REAPER_STALE_AFTER ({stale_after}s) must be larger than '
+                         f'ORKA_HEARTBEAT_INTERVAL ({heartbeat_interval}s).')
+
+    thread = Thread(target=_reap_periodically, args=(app, interval), daemon=True)
+    thread.start()
+    return thread
+
+
+def start_heartbeat(app):
+    """Keep the jobs queued in this process from being considered crashed while they wait for a slot."""
+    interval = app.config['ORKA_HEARTBEAT_INTERVAL']
+    if not interval:
+        return None
+
+    thread = Thread(target=_touch_periodically, args=(app, interval), daemon=True)
+    thread.start()
+    return thread
+
+
+def _touch_periodically(app, interval):
+    while True:
+        time.sleep(interval)
+        data_ids = scheduler.get_queued_keys()
+        if len(data_ids) == 0:
+            continue
+        try:
+            with app.app_context():
+                conn = db.pool.getconn()
+                try:
+                    touch_queued_jobs(conn, app, data_ids)
+                finally:
+                    db.pool.putconn(conn)
+        except Exception as e:
+            app.logger.info(f'Error touching queued jobs. {e}')
+
+
+def _reap_periodically(app, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            with app.app_context():
+                conn = db.pool.getconn()
+                try:
+                    reap(conn, app)
+                finally:
+                    db.pool.putconn(conn)
+        except Exception as e:
+            app.logger.info(f'Error reaping jobs. {e}')
+
+
+def reap(conn, app):
+    """Remove expired jobs, orphaned files and enforce the disk budget of the geopackages.
+
+    Only one process runs the reaper at a time, all others skip the run.
+    """
+    with conn.cursor() as cur:
+        cur.execute('SELECT pg_try_advisory_lock(%(key)s);', {'key': _REAPER_LOCK_KEY})
+        locked, = cur.fetchone()
+    if not locked:
+        conn.commit()
+        return
+
+    try:
+        stale = mark_stale_jobs(conn, app)
+        if stale > 0:
+            app.logger.info(f'Marked {stale} stale jobs as {Status.ERROR.value}.')
+        for status, ttl in app.config['ORKA_JOB_TTL'].items():
+            expired = delete_expired_jobs(conn, app, status, ttl)
+            if expired > 0:
+                app.logger.info(f'Deleted {expired} expired jobs with status {status}.')
+        swept = sweep_orphaned_files(conn, app)
+        if swept > 0:
+            app.logger.info(f'Deleted {swept} orphaned files.')
+        evicted = enforce_disk_budget(conn, app)
+        if evicted > 0:
+            app.logger.info(f'Evicted {evicted} jobs to enforce the disk budget.')
+    finally:
+        with conn.cursor() as cur:
+            cur.execute('SELECT pg_advisory_unlock(%(key)s);', {'key': _REAPER_LOCK_KEY})
+        conn.commit()
+
+
+def mark_stale_jobs(conn, app):
+    """Mark jobs that did not report for too long as failed, e.g. after a crash of the worker.
+
+    Exports send a heartbeat while they wait and run, and exports queued or
+    running in this process are never marked. Their staging files are kept, so
+    the jobs can be resumed.
+    """
+    schema = _get_schema(app)
+    stale_after = get_stale_after(app)
+    if stale_after is None:
+        return 0
+
+    q = SQL('UPDATE {schema}.{table} SET status = %(error)s, updated_at = now() '
+            'WHERE status IN (%(init)s, %(queued)s, %(running)s) '
+            'AND updated_at < now() - %(seconds)s * interval \'1 second\' '
+            'AND NOT COALESCE(data_id = ANY(%(live)s), false);').format(
+        schema=Identifier(schema),
+        table=Identifier('jobs')
+    )
+
+    with conn.cursor() as cur:
+        cur.execute(q, {
+            'error': Status.ERROR.value,
+            'init': Status.INIT.value,
+            'queued': Status.QUEUED.value,
+            'running': Status.RUNNING.value,
+            'seconds': stale_after,
+            'live': get_live_exports() + scheduler.get_queued_keys()
+        })
+        count = cur.rowcount
+        conn.commit()
+
+    return count
+
+
+def get_stale_after(app):
+    """Get the seconds after which a job that did not report is considered crashed, or None if never."""
+    stale_after = app.config['ORKA_REAPER_STALE_AFTER']
+    if stale_after is not None:
+        return stale_after
+
+    # a few heartbeats may be missed, e.g. while the api is busy
+    candidates = [2 * app.config['ORKA_THREAD_TIMEOUT'] if app.config['ORKA_THREAD_TIMEOUT'] else None,
+                  3 * app.config['ORKA_HEARTBEAT_INTERVAL'] if app.config['ORKA_HEARTBEAT_INTERVAL'] else None]
+    candidates = [c for c in candidates if c is not None]
+    if len(candidates) == 0:
+        return None
+    return max(candidates)
+
+
+def touch_queued_jobs(conn, app, data_ids):
+    """Set the update time of the queued jobs of given data_ids to now."""
+    schema = _get_schema(app)
+    q = SQL('UPDATE {schema}.{table} SET updated_at = now() '
+            'WHERE status = %(queued)s AND data_id = ANY(%(data_ids)s);').format(
+        schema=Identifier(schema),
+        table=Identifier('jobs')
+    )
+
+    with conn.cursor() as cur:
+        cur.execute(q, {'queued': Status.QUEUED.value, 'data_ids': data_ids})
+        count = cur.rowcount
+        conn.commit()
+
+    return count
+
+
+def delete_expired_jobs(conn, app, status, ttl):
+    """Delete jobs with given status that were not updated within `ttl` seconds, including their files."""
+    schema = _get_schema(app)
+    batch_size = app.config['ORKA_REAPER_BATCH_SIZE']
+
+    q = SQL('DELETE FROM {schema}.{table} WHERE id IN ('
+            'SELECT id FROM {schema}.{table} '
+            'WHERE status = %(status)s AND updated_at < now() - %(seconds)s * interval \'1 second\' '
+            'LIMIT %(limit)s) '
+            'RETURNING data_id;').format(
+        schema=Identifier(schema),
+        table=Identifier('jobs')
+    )
+
+    count = 0
+    while True:
+        with conn.cursor() as cur:
+            cur.execute(q, {'status': status, 'seconds': ttl, 'limit': batch_size})
+            data_ids = [data_id for data_id, in cur.fetchall()]
+            conn.commit()
+        # files shared with jobs that are not expired yet are kept
+        shared = _get_statuses(conn, app, list(set(data_ids)))
+        _delete_files(app, [data_id for data_id in set(data_ids) if data_id not in shared])
+        count += len(data_ids)
+        if len(data_ids) < batch_size:
+            return count
+
+
+def sweep_orphaned_files(conn, app):
+    """Delete files without a job and staging files of jobs that are already created."""
+    files = _list_gpkg_files(app)
+    if len(files) == 0:
+        return 0
+
+    statuses = _get_statuses(conn, app, list({data_id for data_id, partial, path, size, mtime in files}))
+
+    count = 0
+    for data_id, partial, path, size, mtime in files:
+        status = statuses.get(data_id)
+        if status is None or (partial and status == Status.CREATED.value):
+            _remove(path)
+            count += 1
+
+    return count
+
+
+def enforce_disk_budget(conn, app):
+    """Delete the jobs with the oldest files until the geopackages fit into the disk budget.
+
+    Staging files of running jobs are never evicted.
+    """
+    budget = app.config['ORKA_GPKG_DISK_BUDGET']
+    if budget is None:
+        return 0
+
+    files = _list_gpkg_files(app)
+    total = sum([size for data_id, partial, path, size, mtime in files])
+    if total <= budget:
+        return 0
+
+    statuses = _get_statuses(conn, app, list({data_id for data_id, partial, path, size, mtime in files}))
+    running = [Status.INIT.value, Status.QUEUED.value, Status.RUNNING.value]
+
+    evict = []
+    for data_id, partial, path, size, mtime in sorted(files, key=lambda f: f[4]):
+        if total <= budget:
+            break
+        if statuses.get(data_id) in running:
+            continue
+        evict.append(data_id)
+        total -= size
+
+    batch_size = app.config['ORKA_REAPER_BATCH_SIZE']
+    for i in range(0, len(evict), batch_size):
+        batch = evict[i:i + batch_size]
+        _delete_jobs_by_dataids(conn, app, batch)
+        _delete_files(app, batch)
+
+    return len(evict)
+
+
+def _get_schema(app):
+    schema = app.config['ORKA_DB_SCHEMA']
+    if not _is_sane_schema(schema):
+        raise Exception('Schema is not sane.')
+    return schema
+
+
+def _get_statuses(conn, app, data_ids):
+    schema = _get_schema(app)
+    q = SQL('SELECT data_id, status FROM {schema}.{table} WHERE data_id = ANY(%(data_ids)s);').format(
+        schema=Identifier(schema),
+        table=Identifier('jobs')
+    )
+
+    with conn.cursor() as cur:
+        cur.execute(q, {'data_ids': data_ids})
+        statuses = {data_id: status for data_id, status in cur.fetchall()}
+        conn.commit()
+
+    return statuses
+
+
+def _delete_jobs_by_dataids(conn, app, data_ids):
+    schema = _get_schema(app)
+    q = SQL('DELETE FROM {schema}.{table} WHERE data_id = ANY(%(data_ids)s);').format(
+        schema=Identifier(schema),
+        table=Identifier('jobs')
+    )
+
+    with conn.cursor() as cur:
+        cur.execute(q, {'data_ids': data_ids})
+        conn.commit()
+
+
+def _list_gpkg_files(app):
+    """List all job files as tuples of data_id, partial, path, size and mtime."""
+    gpkg_path = app.config['ORKA_GPKG_PATH']
+    files = []
+    for f_name in os.listdir(gpkg_path):
+        parsed = _parse_gpkg_filename(f_name)
+        if parsed is None:
+            continue
+        data_id, partial = parsed
+        path = os.path.abspath(os.path.join(gpkg_path, f_name))
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        files.append((data_id, partial, path, stat.st_size, stat.st_mtime))
+
+    return files
+
+
+def _parse_gpkg_filename(f_name):
+    suffixes = [(f'.partial.{f.value}', True) for f in OutputFormat] + [(f'.{f.value}', False) for f in OutputFormat]
+    for suffix, partial in suffixes:
+        if f_name.endswith(suffix):
+            data_id = f_name[:-len(suffix)]
+            try:
+                uuid.UUID(data_id)
+            except ValueError:
+                return None
+            return data_id, partial
+
+    return None
+
+
+def _delete_files(app, data_ids):
+    gpkg_path = app.config['ORKA_GPKG_PATH']
+    for data_id in data_ids:
+        if data_id is None:
+            continue
+        for path in get_output_filenames(gpkg_path, data_id):
+            _remove(path)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,24 @@
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+
+_DOWNLOAD_SALT = 'orka-download'
+
+
+def create_download_token(app, data_id):
+    """Create a signed token that grants the download of the geopackage with given data_id."""
+    return _get_serializer(app).dumps({'data_id': data_id})
+
+
+def verify_download_token(app, token, data_id):
+    """Check that the token was issued for given data_id and is not yet expired."""
+    max_age = app.config['ORKA_DOWNLOAD_TOKEN_TTL']
+    try:
+        payload = _get_serializer(app).loads(token, max_age=max_age)
+    except BadSignature:
+        # also covers expired tokens
+        return False
+
+    return isinstance(payload, dict) and payload.get('data_id') == data_id
+
+
+def _get_serializer(app):
+    return URLSafeTimedSerializer(app.config['SECRET_KEY'], salt=_DOWNLOAD_SALT)
@@ -0,0 +1,249 @@
+import json
+import os
+import time
+from threading import Lock, Thread
+
+import psycopg2
+
+
+class LayerRegistry(object):
+    """Holds the layer sqls of ORKA_LAYERS_PATH in memory.
+
+    The sqls are loaded on startup and reloaded when files in the layer folder
+    change. Statistics of each layer (SRID, extent, feature count and average
+    feature size) are taken from the PostgreSQL statistics on a schedule.
+    """
+
+    def __init__(self, app=None):
+        self.app = app
+        self.layers = {}
+        self.errors = {}
+        self.stats = {}
+        self.signature = None
+        self.last_check = 0
+        self.lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ORKA_LAYER_RELOAD_INTERVAL', 10)
+        app.config.setdefault('ORKA_LAYER_STATS_INTERVAL', 3600)
+
+        self.app = app
+        self.layers_path = os.path.abspath(app.config['ORKA_LAYERS_PATH'])
+        self.reload_interval = app.config['ORKA_LAYER_RELOAD_INTERVAL']
+        self.reload()
+
+        stats_interval = app.config['ORKA_LAYER_STATS_INTERVAL']
+        if stats_interval:
+            thread = Thread(target=self._refresh_stats_periodically, args=(stats_interval,), daemon=True)
+            thread.start()
+
+    def reload(self):
+        """Load and validate all layer sqls."""
+        with self.lock:
+            self.signature = self._get_signature()
+            self.last_check = time.time()
+            layers = {}
+            errors = {}
+            for f_name, mtime in self.signature:
+                f_root = os.path.splitext(f_name)[0]
+                try:
+                    with open(os.path.join(self.layers_path, f_name)) as f:
+                        sql = ' '.join(f.read().splitlines()).strip().rstrip(';')
+                except OSError as e:
+                    errors[f_root] = f'Could not read layer sql: {e}'
+                    continue
+                error = _validate_sql(sql)
+                if error is not None:
+                    errors[f_root] = error
+                    continue
+                layers[f_root] = sql
+            # statistics of changed layers, e.g. their columns, are outdated until the next refresh
+            self.stats = {k: v for k, v in self.stats.items() if k in layers and layers[k] == self.layers.get(k)}
+            self.layers = layers
+            self.errors = errors
+        for layer_name, error in errors.items():
+            self.app.logger.warning(f'Layer {layer_name} is invalid. {error}')
+
+    def get_sqls(self, layer_names=None):
+        """Get the sqls of given layers, or of all layers if layer_names is None."""
+        self._reload_if_changed()
+        layers = self.layers
+        if layer_names is None:
+            return dict(layers)
+        return {k: v for k, v in layers.items() if k in layer_names}
+
+    def has_layers(self, layer_names):
+        self._reload_if_changed()
+        return False not in [n in self.layers for n in layer_names]
+
+    def get_catalog(self):
+        """Get the description and statistics of all layers."""
+        self._reload_if_changed()
+        catalog = []
+        for layer_name in sorted(list(self.layers.keys()) + list(self.errors.keys())):
+            stats = self.stats.get(layer_name, {})
+            catalog.append({
+                'name': layer_name,
+                'valid': layer_name in self.layers,
+                'error': self.errors.get(layer_name, stats.get('error')),
+                'srid': stats.get('srid'),
+                'extent': stats.get('extent'),
+                'feature_count': stats.get('feature_count'),
+                'avg_feature_size': stats.get('avg_feature_size'),
+                'columns': stats.get('columns'),
+                'updated': stats.get('updated')
+            })
+        return catalog
+
+    def get_stats(self, layer_name):
+        return self.stats.get(layer_name)
+
+    def refresh_stats(self, conn):
+        """Refresh the statistics of all layers using given connection to the vector database."""
+        stats = {}
+        for layer_name, sql in self.get_sqls().items():
+            try:
+                stats[layer_name] = _get_layer_stats(conn, sql)
+            except psycopg2.Error as e:
+                conn.rollback()
+                self.app.logger.info(f'Could not get statistics of layer {layer_name}. {e}')
+                stats[layer_name] = {'error': str(e).strip(), 'updated': time.time()}
+        self.stats = stats
+
+    def estimate(self, conn, bbox, layer_names=None):
+        """Estimate the number of features and the size in bytes of each layer within the bbox.
+
+        The estimates are taken from the query planner, so no data is read.
+        """
+        from orka_vector_api.helper.gdal_helper import _get_gpkg_sql
+
+        estimates = {}
+        with conn.cursor() as cur:
+            for layer_name, sql in self.get_sqls(layer_names).items():
+                cur.execute('EXPLAIN (FORMAT JSON) ' + _get_gpkg_sql(sql, bbox).replace('%', '%%'), {})
+                plan = cur.fetchone()[0]
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                features = plan[0]['Plan']['Plan Rows']
+                stats = self.stats.get(layer_name, {})
+                feature_size = stats.get('avg_feature_size') or plan[0]['Plan']['Plan Width']
+                estimates[layer_name] = {
+                    'features': features,
+                    'bytes': features * feature_size
+                }
+        conn.rollback()
+
+        return estimates
+
+    def _refresh_stats_periodically(self, interval):
+        while True:
+            try:
+                conn = psycopg2.connect(
+                    host=self.app.config['PG_HOST'],
+                    port=self.app.config['PG_PORT'],
+                    database=self.app.config['PG_DATABASE'],
+                    user=self.app.config['PG_USER'],
+                    password=self.app.config['PG_PASSWORD']
+                )
+                try:
+                    self.refresh_stats(conn)
+                finally:
+                    conn.close()
+            except Exception as e:
+                self.app.logger.info(f'Error refreshing layer statistics. {e}')
+            time.sleep(interval)
+
+    def _reload_if_changed(self):
+        if time.time() - self.last_check < self.reload_interval:
+            return
+        self.last_check = time.time()
+        if self._get_signature() != self.signature:
+            self.app.logger.info('Layer sqls changed. Reloading.')
+            self.reload()
+
+    def _get_signature(self):
+        signature = []
+        if not os.path.isdir(self.layers_path):
+            return signature
+        for f_name in sorted(os.listdir(self.layers_path)):
+            f_path = os.path.join(self.layers_path, f_name)
+            if not os.path.isfile(f_path) or not os.path.splitext(f_name)[1] == '.sql':
+                continue
+            signature.append((f_name, os.path.getmtime(f_path)))
+        return signature
+
+
+def _validate_sql(sql):
+    if len(sql) == 0:
+        return 'Layer sql is empty.'
+    if ';' in sql:
+        return 'Layer sql must be a single statement.'
+    if not sql.lower().startswith(('select', 'with', '(')):
+        return 'Layer sql must be a query.'
+    return None
+
+
+def _get_layer_stats(conn, sql):
+    with conn.cursor() as cur:
+        cur.execute(f'SELECT * FROM ({sql}) AS l LIMIT 0')
+        columns = [d.name for d in cur.description]
+        geom_column = [d for d in cur.description if d.name == 'geometry']
+        if len(geom_column) == 0:
+            raise psycopg2.ProgrammingError('Layer sql has no column named geometry.')
+
+        cur.execute(f'EXPLAIN (FORMAT JSON) SELECT * FROM ({sql}) AS l')
+        plan = cur.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        feature_count = plan[0]['Plan']['Plan Rows']
+        avg_feature_size = plan[0]['Plan']['Plan Width']
+
+        cur.execute(f'SELECT ST_SRID(l.geometry) FROM ({sql}) AS l LIMIT 1')
+        row = cur.fetchone()
+        srid = row[0] if row is not None else None
+
+        extent = _get_estimated_extent(cur, geom_column[0], srid)
+    conn.rollback()
+
+    return {
+        'srid': srid,
+        'extent': extent,
+        'feature_count': feature_count,
+        'avg_feature_size': avg_feature_size,
+        'columns': columns,
+        'updated': time.time()
+    }
+
+
+def _get_estimated_extent(cur, geom_column, srid):
+    """Get the extent in EPSG:4326 of the table the geometry column originates from.
+
+    Uses the statistics of the table, so it is only available after the table was analyzed.
+    """
+    if geom_column.table_oid is None or srid is None:
+        return None
+
+    cur.execute('SELECT n.nspname, c.relname, a.attname '
+                'FROM pg_class c '
+                'JOIN pg_namespace n ON n.oid = c.relnamespace '
+                'JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum = %(attnum)s '
+                'WHERE c.oid = %(oid)s;', {'oid': geom_column.table_oid, 'attnum': geom_column.table_column})
+    row = cur.fetchone()
+    if row is None:
+        return None
+
+    # depending on the PostGIS version, missing statistics raise an error
+    cur.execute('SAVEPOINT estimated_extent;')
+    try:
+        cur.execute('SELECT ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e) FROM ('
+                    'SELECT ST_Transform(ST_SetSRID(ST_EstimatedExtent(%(schema)s, %(table)s, %(column)s)::geometry, '
+                    '%(srid)s), 4326) AS e) AS t;', {'schema': row[0], 'table': row[1], 'column': row[2], 'srid': srid})
+        extent = cur.fetchone()
+    except psycopg2.Error:
+        cur.execute('ROLLBACK TO SAVEPOINT estimated_extent;')
+        return None
+    if extent is None or extent[0] is None:
+        return None
+    return list(extent)
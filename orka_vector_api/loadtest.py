@@ -0,0 +1,354 @@
+"""Load test that replays client sessions against a running OrKa Vector API.
+
+A session adds a job, polls it until it is finished, downloads the data
+package and the styles and deletes the job again. Sessions arrive as a
+Poisson process with random bboxes and layer sets, so the load resembles the
+production traffic.
+
+Run it with `orka-loadtest http://localhost:5000 --rate 0.5 --duration 300`.
+For runs without a vector database, set `ORKA_EXPORT_ENGINE = 'fake'` in the
+config of the app.
+"""
+import argparse
+import json
+import math
+import random
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+import requests
+
+# the endpoints of a session in the order they are called
+ENDPOINTS = ['create_job', 'poll_job', 'get_data', 'get_styles', 'delete_job']
+
+_KM_PER_DEGREE = 111.32
+
+
+class LoadTestStats(object):
+    """Collects the latencies and outcomes of all requests and sessions."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.latencies = {e: [] for e in ENDPOINTS}
+        self.errors = {e: 0 for e in ENDPOINTS}
+        self.sessions = 0
+        self.completed = 0
+        self.failed = 0
+        self.no_threads = 0
+        self.rate_limited = 0
+        self.start = time.time()
+        self.end = None
+
+    def add_request(self, endpoint, seconds, error=False):
+        with self.lock:
+            self.latencies[endpoint].append(seconds)
+            if error:
+                self.errors[endpoint] += 1
+
+    def add_error(self, endpoint):
+        with self.lock:
+            self.errors[endpoint] += 1
+
+    def add_session(self, outcome):
+        with self.lock:
+            self.sessions += 1
+            if outcome == 'completed':
+                self.completed += 1
+            elif outcome == 'no_threads':
+                self.no_threads += 1
+            elif outcome == 'rate_limited':
+                self.rate_limited += 1
+            else:
+                self.failed += 1
+
+    def get_report(self):
+        with self.lock:
+            elapsed = (self.end or time.time()) - self.start
+            requests_total = sum([len(v) for v in self.latencies.values()])
+            errors_total = sum(self.errors.values())
+            endpoints = {}
+            for endpoint in ENDPOINTS:
+                latencies = sorted(self.latencies[endpoint])
+                endpoints[endpoint] = {
+                    'requests': len(latencies),
+                    'errors': self.errors[endpoint],
+                    'p50': _percentile(latencies, 0.5),
+                    'p95': _percentile(latencies, 0.95),
+                    'p99': _percentile(latencies, 0.99),
+                    'max': round(latencies[-1], 3) if len(latencies) > 0 else None
+                }
+
+            return {
+                'elapsed': round(elapsed, 1),
+                'sessions': self.sessions,
+                'completed': self.completed,
+                'failed': self.failed,
+                'no_threads': self.no_threads,
+                'rate_limited': self.rate_limited,
+                'throughput': round(self.completed / elapsed, 3) if elapsed > 0 else 0,
+                'requests_per_second': round(requests_total / elapsed, 3) if elapsed > 0 else 0,
+                'error_rate': _rate(errors_total, requests_total),
+                'session_error_rate': _rate(self.failed, self.sessions),
+                'no_threads_rate': _rate(self.no_threads, self.sessions),
+                'rate_limited_rate': _rate(self.rate_limited, self.sessions),
+                'endpoints': endpoints
+            }
+
+
+def run_session(base_url, stats, rnd, args):
+    """Run the workflow of a single client and return its outcome."""
+    session = requests.Session()
+    if args.api_key is not None:
+        session.headers[args.api_key_header] = args.api_key
+    try:
+        body = {
+            'bbox': random_bbox(rnd, args.area, args.bbox_km),
+            'format': args.format
+        }
+        layers = _choose(rnd, args.layer_mix)
+        if layers is not None:
+            body['layers'] = list(layers)
+        headers = {'Idempotency-Key': str(uuid.uuid4())} if args.idempotency else {}
+
+        response = _request(session, stats, 'create_job', 'post', f'{base_url}/jobs/', args.request_timeout,
+                            ok=[201, 400, 429], json=body, headers=headers)
+        if response is None:
+            return 'failed'
+        if response.status_code == 429:
+            return 'rate_limited'
+        result = _json(response)
+        if response.status_code == 400:
+            if result.get('message') == 'NO_THREADS_AVAILABLE':
+                return 'no_threads'
+            stats.add_error('create_job')
+            return 'failed'
+        job_id = result['job_id']
+
+        job = None
+        deadline = time.time() + args.job_timeout
+        while time.time() < deadline:
+            response = _request(session, stats, 'poll_job', 'get', f'{base_url}/jobs/{job_id}', args.request_timeout)
+            if response is not None:
+                job = _json(response)
+                if job.get('status') not in ['INIT', 'QUEUED', 'RUNNING']:
+                    break
+            time.sleep(args.poll_interval)
+
+        outcome = 'failed'
+        if job is not None and job.get('status') == 'CREATED':
+            download_url = job.get('download_url') or f'/data/{job["data_id"]}'
+            if _request(session, stats, 'get_data', 'get', base_url + download_url, args.request_timeout,
+                        stream=True) is not None:
+                outcome = 'completed'
+
+        _request(session, stats, 'get_styles', 'get', f'{base_url}/data/styles', args.request_timeout, stream=True)
+        _request(session, stats, 'delete_job', 'delete', f'{base_url}/jobs/{job_id}', args.request_timeout)
+        return outcome
+    finally:
+        session.close()
+
+
+def random_bbox(rnd, area, bbox_km):
+    """Get a random bbox in EPSG:4326 within the area, with a side length drawn from the size distribution."""
+    size_km = _choose(rnd, bbox_km)
+    lat = rnd.uniform(area[1], area[3])
+    lon = rnd.uniform(area[0], area[2])
+    half_lat = size_km / _KM_PER_DEGREE / 2
+    half_lon = size_km / (_KM_PER_DEGREE * math.cos(math.radians(lat))) / 2
+    return [round(lon - half_lon, 6), round(lat - half_lat, 6), round(lon + half_lon, 6), round(lat + half_lat, 6)]
+
+
+def run(args):
+    stats = LoadTestStats()
+    rnd = random.Random(args.seed)
+    base_url = args.url.rstrip('/')
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = []
+        next_arrival = time.time()
+        end = time.time() + args.duration
+        while next_arrival < end and (args.sessions is None or len(futures) < args.sessions):
+            time.sleep(max(next_arrival - time.time(), 0))
+            session_rnd = random.Random(rnd.random())
+            futures.append(executor.submit(_run_and_record, base_url, stats, session_rnd, args))
+            # exponential inter-arrival times make the arrivals a Poisson process
+            next_arrival += rnd.expovariate(args.rate)
+        for future in futures:
+            future.result()
+    stats.end = time.time()
+
+    return stats.get_report()
+
+
+def check_slos(report, slos):
+    """Get the list of violated SLOs.
+
+    Rates, latencies and `<endpoint>.<percentile>` are upper bounds, `throughput`
+    is a lower bound.
+    """
+    violations = []
+    for key, limit in slos.items():
+        if '.' in key:
+            endpoint, metric = key.split('.', 1)
+            value = report['endpoints'].get(endpoint, {}).get(metric)
+        else:
+            value = report.get(key)
+        if value is None:
+            continue
+        if key == 'throughput':
+            if value < limit:
+                violations.append(f'{key} {value} < {limit}')
+        elif value > limit:
+            violations.append(f'{key} {value} > {limit}')
+
+    return violations
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='orka-loadtest', description=__doc__.splitlines()[0])
+    parser.add_argument('url', help='base url of the api, e.g. http://localhost:5000')
+    parser.add_argument('--rate', type=float, default=0.2, help='mean number of new sessions per second')
+    parser.add_argument('--duration', type=float, default=60, help='seconds during which new sessions arrive')
+    parser.add_argument('--sessions', type=int, default=None, help='maximum number of sessions')
+    parser.add_argument('--concurrency', type=int, default=50, help='maximum number of concurrent sessions')
+    parser.add_argument('--area', type=_parse_floats, default=[12.5, 53.2, 13.2, 53.6],
+                        help='area the bbox centers are drawn from, as minx,miny,maxx,maxy in EPSG:4326')
+    parser.add_argument('--bbox-km', type=_parse_weights(float), default={1.0: 0.6, 5.0: 0.3, 20.0: 0.1},
+                        help='distribution of the bbox side length in km, e.g. 1:0.6,5:0.3,20:0.1')
+    parser.add_argument('--layer-mix', type=_parse_weights(_parse_layers), default={None: 1},
+                        help='distribution of the requested layers, e.g. all:0.7,roads+buildings:0.3')
+    parser.add_argument('--format', default='gpkg', help='format of the data packages')
+    parser.add_argument('--poll-interval', type=float, default=1, help='seconds between two polls of a job')
+    parser.add_argument('--job-timeout', type=float, default=600, help='seconds after which a session gives up on a job')
+    parser.add_argument('--request-timeout', type=float, default=60, help='timeout of a single request in seconds')
+    parser.add_argument('--api-key', default=None, help='api key sent with each request')
+    parser.add_argument('--api-key-header', default='X-Api-Key', help='name of the header of the api key')
+    parser.add_argument('--idempotency', action='store_true', help='send an Idempotency-Key with each new job')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the random generator')
+    parser.add_argument('--slo', action='append', default=[], type=_parse_slo,
+                        help='fail if missed, e.g. create_job.p95=0.5, error_rate=0.01, no_threads_rate=0.05 or '
+                             'throughput=0.1. May be given multiple times')
+    parser.add_argument('--json', action='store_true', help='print the report as json')
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = run(args)
+    violations = check_slos(report, dict(args.slo))
+    report['slo_violations'] = violations
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        _print_report(report)
+
+    return 1 if len(violations) > 0 else 0
+
+
+def _run_and_record(base_url, stats, rnd, args):
+    try:
+        outcome = run_session(base_url, stats, rnd, args)
+    except Exception as e:
+        print(f'Unexpected error in session: {e}', file=sys.stderr)
+        outcome = 'failed'
+    stats.add_session(outcome)
+
+
+def _request(session, stats, endpoint, method, url, timeout, ok=None, stream=False, **kwargs):
+    """Send a request and record its latency. Returns None on errors."""
+    ok = ok or [200, 201]
+    start = time.perf_counter()
+    try:
+        response = session.request(method, url, timeout=timeout, stream=stream, **kwargs)
+        if stream:
+            # the latency of a download includes the transfer
+            for _ in response.iter_content(chunk_size=64 * 1024):
+                pass
+    except requests.RequestException:
+        stats.add_request(endpoint, time.perf_counter() - start, error=True)
+        return None
+
+    error = response.status_code not in ok
+    stats.add_request(endpoint, time.perf_counter() - start, error=error)
+    return None if error else response
+
+
+def _json(response):
+    try:
+        return response.json()
+    except ValueError:
+        return {}
+
+
+def _choose(rnd, weights):
+    return rnd.choices(list(weights.keys()), weights=list(weights.values()))[0]
+
+
+def _percentile(values, p):
+    if len(values) == 0:
+        return None
+    return round(values[min(int(len(values) * p), len(values) - 1)], 3)
+
+
+def _rate(count, total):
+    return round(count / total, 4) if total > 0 else 0
+
+
+def _parse_floats(value):
+    floats = [float(v) for v in value.split(',')]
+    if len(floats) != 4:
+        raise argparse.ArgumentTypeError('Expected four comma separated numbers.')
+    return floats
+
+
+def _parse_layers(value):
+    if value == 'all':
+        return None
+    return tuple(value.split('+'))
+
+
+def _parse_weights(parse_key):
+    def parse(value):
+        weights = {}
+        for item in value.split(','):
+            key, _, weight = item.rpartition(':')
+            if key == '':
+                key, weight = weight, '1'
+            weights[parse_key(key)] = float(weight)
+        return weights
+    return parse
+
+
+def _parse_slo(value):
+    key, _, limit = value.partition('=')
+    try:
+        return key, float(limit)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Invalid SLO {value}.')
+
+
+def _print_report(report):
+    print(f'{report["sessions"]} sessions in {report["elapsed"]}s: {report["completed"]} completed, '
+          f'{report["failed"]} failed, {report["no_threads"]} NO_THREADS_AVAILABLE, '
+          f'{report["rate_limited"]} rate limited')
+    print(f'throughput {report["throughput"]} sessions/s, {report["requests_per_second"]} requests/s, '
+          f'error rate {report["error_rate"]}, NO_THREADS_AVAILABLE rate {report["no_threads_rate"]}')
+    print(f'{"endpoint":<12} {"requests":>8} {"errors":>7} {"p50":>8} {"p95":>8} {"p99":>8} {"max":>8}')
+    for endpoint, e in report['endpoints'].items():
+        print(f'{endpoint:<12} {e["requests"]:>8} {e["errors"]:>7} ' +
+              ' '.join([f'{_format_seconds(e[k]):>8}' for k in ['p50', 'p95', 'p99', 'max']]))
+    for violation in report['slo_violations']:
+        print(f'SLO missed: {violation}')
+
+
+def _format_seconds(seconds):
+    return '-' if seconds is None else f'{seconds:.3f}'
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -32,6 +32,17 @@ class OrkaDB(object):
             password=current_app.config['ORKA_DB_PASSWORD']
         )
 
+    def create_source_pool(self):
+        return ThreadedConnectionPool(
+            1,
+            1,
+            host=current_app.config['PG_HOST'],
+            port=current_app.config['PG_PORT'],
+            database=current_app.config['PG_DATABASE'],
+            user=current_app.config['PG_USER'],
+            password=current_app.config['PG_PASSWORD']
+        )
+
     @property
     def pool(self):
         ctx = _app_ctx_stack.top
@@ -40,3 +51,12 @@ class OrkaDB(object):
                 ctx.orka_db_pool = self.create_pool()
             return ctx.orka_db_pool
 
+    @property
+    def source_pool(self):
+        """Pool of connections to the database containing the vector layers."""
+        ctx = _app_ctx_stack.top
+        if ctx is not None:
+            if not hasattr(ctx, 'orka_source_db_pool'):
+                ctx.orka_source_db_pool = self.create_source_pool()
+            return ctx.orka_source_db_pool
+
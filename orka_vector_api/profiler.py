@@ -0,0 +1,197 @@
+import os
+import sys
+import time
+from collections import Counter, OrderedDict
+from threading import Event, Lock, Thread
+
+
+class _NoSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+class _NoProfile(object):
+    """Stands in for a profile while profiling is disabled, so callers need no checks."""
+
+    enabled = False
+    _span = _NoSpan()
+
+    def span(self, name, **attrs):
+        return self._span
+
+    def add_span(self, name, start, seconds, **attrs):
+        pass
+
+    def add_explain(self, name, plan):
+        pass
+
+    def sample_stacks(self, thread, interval):
+        return None
+
+
+NO_PROFILE = _NoProfile()
+
+
+class _Span(object):
+    def __init__(self, profile, name, attrs):
+        self.profile = profile
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.start = time.time()
+        self.perf_start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        self.profile.add_span(self.name, self.start, time.perf_counter() - self.perf_start, **self.attrs)
+        return False
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+
+class Profile(object):
+    """The timing spans, sampled stacks and query plans of a single job."""
+
+    enabled = True
+
+    def __init__(self, max_spans=1000, max_stacks=50):
+        self.lock = Lock()
+        self.max_spans = max_spans
+        self.max_stacks = max_stacks
+        self.spans = []
+        self.stacks = Counter()
+        self.explains = {}
+
+    def span(self, name, **attrs):
+        """Measure the duration of a with block."""
+        return _Span(self, name, attrs)
+
+    def add_span(self, name, start, seconds, **attrs):
+        with self.lock:
+            if len(self.spans) >= self.max_spans:
+                return
+            self.spans.append({'name': name, 'start': start, 'seconds': round(seconds, 4), **attrs})
+
+    def add_explain(self, name, plan):
+        with self.lock:
+            self.explains[name] = plan
+
+    def merge(self, other):
+        with other.lock:
+            spans = list(other.spans)
+            stacks = Counter(other.stacks)
+            explains = dict(other.explains)
+        with self.lock:
+            self.spans = (self.spans + spans)[:self.max_spans]
+            self.stacks.update(stacks)
+            self.explains.update(explains)
+
+    def sample_stacks(self, thread, interval):
+        """Sample the python stack of the thread every `interval` seconds until the returned event is set."""
+        stop_e = Event()
+        sampler = Thread(target=self._sample, args=(thread, interval, stop_e), daemon=True)
+        sampler.start()
+        return stop_e
+
+    def to_dict(self):
+        with self.lock:
+            spans = sorted(self.spans, key=lambda s: s['start'])
+            first = spans[0]['start'] if len(spans) > 0 else 0
+            return {
+                'spans': [{**s, 'start': round(s['start'] - first, 4)} for s in spans],
+                'started': first,
+                'stacks': [{'stack': k, 'samples': v} for k, v in self.stacks.most_common(self.max_stacks)],
+                'explains': dict(self.explains)
+            }
+
+    def _sample(self, thread, interval, stop_e):
+        while not stop_e.wait(interval):
+            if not thread.is_alive():
+                return
+            frame = sys._current_frames().get(thread.ident)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}')
+                frame = frame.f_back
+            with self.lock:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+
+class Profiler(object):
+    """Opt-in profiling of requests and exports.
+
+    The profiles of the most recent jobs are kept in memory of the process that
+    handled them. While profiling is disabled, all profiles are no-ops.
+    """
+
+    def __init__(self, app=None):
+        self.app = app
+        self.enabled = False
+        self.lock = Lock()
+        self.profiles = OrderedDict()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ORKA_PROFILING', False)
+        app.config.setdefault('ORKA_PROFILE_MAX_JOBS', 100)
+        app.config.setdefault('ORKA_PROFILE_STACK_INTERVAL', None)
+        app.config.setdefault('ORKA_PROFILE_EXPLAIN_AFTER', None)
+
+        self.app = app
+        self.enabled = app.config['ORKA_PROFILING']
+        self.max_jobs = app.config['ORKA_PROFILE_MAX_JOBS']
+        self.stack_interval = app.config['ORKA_PROFILE_STACK_INTERVAL']
+        self.explain_after = app.config['ORKA_PROFILE_EXPLAIN_AFTER']
+        with self.lock:
+            self.profiles = OrderedDict()
+
+    def new_profile(self):
+        """Get a profile that is not yet related to a job, e.g. for a request that creates one."""
+        if not self.enabled:
+            return NO_PROFILE
+        return Profile()
+
+    def get_profile(self, job_id):
+        """Get the profile of a job, creating it if needed."""
+        if not self.enabled:
+            return NO_PROFILE
+        with self.lock:
+            profile = self.profiles.get(job_id)
+            if profile is None:
+                profile = Profile()
+                self.profiles[job_id] = profile
+            self._touch(job_id)
+            return profile
+
+    def save(self, job_id, profile):
+        """Add the spans of the profile to the profile of the job."""
+        if not self.enabled or not profile.enabled:
+            return
+        self.get_profile(job_id).merge(profile)
+
+    def to_dict(self, job_id):
+        with self.lock:
+            profile = self.profiles.get(job_id)
+        if profile is None:
+            return None
+        return profile.to_dict()
+
+    def _touch(self, job_id):
+        """Mark the job as recently used and evict the least recently used jobs. Must be called with the lock held."""
+        self.profiles.move_to_end(job_id)
+        while len(self.profiles) > self.max_jobs:
+            self.profiles.popitem(last=False)
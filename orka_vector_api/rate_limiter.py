@@ -0,0 +1,59 @@
+import time
+from threading import Lock
+
+
+class RateLimiter(object):
+    """In-memory token bucket rate limits per client.
+
+    Each client gets a bucket of `burst` tokens that refills with `rate` tokens
+    per second. Buckets that are full again are dropped, so the memory only
+    grows with the number of recently active clients.
+    """
+
+    def __init__(self, app=None):
+        self.app = app
+        self.lock = Lock()
+        self.buckets = {}
+        self.last_cleanup = time.monotonic()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ORKA_RATE_LIMITS', {
+            'interactive': {'rate': 0.5, 'burst': 10},
+            'bulk': {'rate': 0.1, 'burst': 5}
+        })
+
+        self.app = app
+        with self.lock:
+            self.buckets = {}
+
+    def acquire(self, client_id, rate, burst):
+        """Take a token from the bucket of the client.
+
+        Returns a tuple of whether a token was available and the seconds until
+        the next token is available.
+        """
+        if rate is None:
+            return True, 0
+
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated, refill = self.buckets.get(client_id, (burst, now, 0))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                tokens -= 1
+                allowed, retry_after = True, 0
+            else:
+                allowed, retry_after = False, (1 - tokens) / rate
+            self.buckets[client_id] = (tokens, now, (burst - tokens) / rate)
+            self._cleanup(now)
+
+        return allowed, retry_after
+
+    def _cleanup(self, now):
+        if now - self.last_cleanup < 60:
+            return
+        self.last_cleanup = now
+        # buckets idle long enough to be refilled completely are equal to new buckets
+        self.buckets = {k: v for k, v in self.buckets.items() if now - v[1] < v[2]}
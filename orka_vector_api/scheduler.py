@@ -0,0 +1,196 @@
+import time
+from collections import OrderedDict, deque
+from threading import Lock, Thread
+
+
+class _Task(object):
+    def __init__(self, client_id, priority, key, target, args, kwargs):
+        self.client_id = client_id
+        self.priority = priority
+        self.key = key
+        self.target = target
+        self.args = args
+        self.kwargs = kwargs
+        self.enqueued = time.time()
+
+
+class JobScheduler(object):
+    """Distributes the export slots of this process fairly across clients.
+
+    Waiting jobs are queued per priority class and client. Priority classes are
+    served by weighted fair queueing, the clients within a class round robin.
+    Slots reserved for a class are never used by other classes, at least one
+    slot is left unreserved and each client may only run a limited number of
+    jobs at once.
+    """
+
+    def __init__(self, app=None):
+        self.app = app
+        self.lock = Lock()
+        self.queues = {}
+        self.virtual_time = {}
+        self.running = {}
+        self.running_clients = {}
+        self.waits = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        # we have a watchdog for each job, so each job needs two threads
+        slots = max(app.config['ORKA_MAX_THREADS'] // 2, 1)
+        app.config.setdefault('ORKA_PRIORITY_CLASSES', {
+            # a single slot cannot be reserved without starving the other classes
+            'interactive': {'weight': 4, 'reserved': 1 if slots > 1 else 0},
+            'bulk': {'weight': 1, 'reserved': 0}
+        })
+        app.config.setdefault('ORKA_CLIENT_MAX_CONCURRENT', 2)
+        app.config.setdefault('ORKA_MAX_QUEUE_LENGTH', 100)
+        app.config.setdefault('ORKA_QUEUE_METRICS_WINDOW', 1000)
+
+        self.app = app
+        self.slots = slots
+        self.classes = app.config['ORKA_PRIORITY_CLASSES']
+        reserved = sum([cfg.get('reserved', 0) for cfg in self.classes.values()])
+        if reserved >= self.slots:
+            raise ValueError(f'{reserved} reserved slots leave none of the {self.slots} slots for the other classes.')
+        # fail on startup instead of on the first job of a misconfigured client
+        priorities = [app.config.get('ORKA_DEFAULT_PRIORITY')]
+        priorities += [s['priority'] for s in app.config.get('ORKA_API_KEYS', {}).values() if 'priority' in s]
+        for priority in priorities:
+            if priority is not None and priority not in self.classes:
+                raise ValueError(f'Unknown priority class {priority}.')
+        self.max_queue_length = app.config['ORKA_MAX_QUEUE_LENGTH']
+        window = app.config['ORKA_QUEUE_METRICS_WINDOW']
+        with self.lock:
+            self.queues = {c: OrderedDict() for c in self.classes}
+            self.virtual_time = {c: 0.0 for c in self.classes}
+            self.running = {c: 0 for c in self.classes}
+            self.running_clients = {}
+            self.waits = {c: deque(maxlen=window) for c in self.classes}
+
+    def submit(self, client_id, priority, max_concurrent, target, *args, key=None, **kwargs):
+        """Queue a job and start it as soon as a slot is available.
+
+        The `key` identifies the job while it waits, see `get_queued_keys`.
+        Returns False if the queue is full.
+        """
+        if priority not in self.classes:
+            raise ValueError(f'Unknown priority class {priority}.')
+
+        with self.lock:
+            if self._queue_length() >= self.max_queue_length:
+                return False
+            client_queues = self.queues[priority]
+            if client_id not in client_queues:
+                client_queues[client_id] = deque()
+            if not self._has_waiting(priority):
+                # an idle class must not accumulate credit while it had nothing to run
+                self.virtual_time[priority] = max(self.virtual_time[priority], self._min_virtual_time())
+            client_queues[client_id].append(_Task(client_id, priority, key, target, args, kwargs))
+            self.running_clients.setdefault(client_id, [0, max_concurrent])[1] = max_concurrent
+            tasks = self._dispatch()
+
+        self._start(tasks)
+        return True
+
+    def get_queued_keys(self):
+        """Get the keys of all jobs waiting for a slot."""
+        with self.lock:
+            return [t.key for queues in self.queues.values() for q in queues.values() for t in q if t.key is not None]
+
+    def get_metrics(self):
+        with self.lock:
+            metrics = {}
+            for c in self.classes:
+                waits = sorted(self.waits[c])
+                metrics[c] = {
+                    'queued': sum([len(q) for q in self.queues[c].values()]),
+                    'running': self.running[c],
+                    'wait_p50': _percentile(waits, 0.5),
+                    'wait_p95': _percentile(waits, 0.95),
+                    'wait_max': waits[-1] if len(waits) > 0 else None
+                }
+            return {
+                'slots': self.slots,
+                'classes': metrics
+            }
+
+    def _start(self, tasks):
+        for task in tasks:
+            thread = Thread(target=self._run, args=(task,))
+            thread.start()
+
+    def _run(self, task):
+        try:
+            task.target(*task.args, **task.kwargs)
+        except Exception as e:
+            self.app.logger.info(f'Unexpected error in scheduled job. {e}')
+        finally:
+            with self.lock:
+                self.running[task.priority] -= 1
+                self.running_clients[task.client_id][0] -= 1
+                if self.running_clients[task.client_id][0] == 0 and not self._is_queued(task.client_id):
+                    self.running_clients.pop(task.client_id)
+                tasks = self._dispatch()
+            self._start(tasks)
+
+    def _dispatch(self):
+        """Pop all tasks that can be started now. Must be called with the lock held."""
+        tasks = []
+        while sum(self.running.values()) < self.slots:
+            candidates = [c for c in self.classes if self._can_start(c) and self._next_client(c) is not None]
+            if len(candidates) == 0:
+                break
+            priority = min(candidates, key=lambda c: self.virtual_time[c])
+            self.virtual_time[priority] += 1.0 / self.classes[priority].get('weight', 1)
+
+            client_id = self._next_client(priority)
+            client_queues = self.queues[priority]
+            task = client_queues[client_id].popleft()
+            # move the client to the end, so the clients of a class take turns
+            client_queues.move_to_end(client_id)
+            if len(client_queues[client_id]) == 0:
+                client_queues.pop(client_id)
+
+            self.running[priority] += 1
+            self.running_clients[client_id][0] += 1
+            wait = time.time() - task.enqueued
+            self.waits[priority].append(wait)
+            self.app.logger.debug(f'Starting job of client {client_id} ({priority}) after {wait:.1f}s in queue.')
+            tasks.append(task)
+
+        return tasks
+
+    def _can_start(self, priority):
+        free = self.slots - sum(self.running.values())
+        reserved_by_others = sum([max(cfg.get('reserved', 0) - self.running[c], 0)
+                                  for c, cfg in self.classes.items() if c != priority])
+        return free > reserved_by_others
+
+    def _next_client(self, priority):
+        for client_id, queue in self.queues[priority].items():
+            running, max_concurrent = self.running_clients[client_id]
+            if len(queue) > 0 and (max_concurrent is None or running < max_concurrent):
+                return client_id
+        return None
+
+    def _has_waiting(self, priority):
+        return True in [len(q) > 0 for q in self.queues[priority].values()]
+
+    def _is_queued(self, client_id):
+        return True in [client_id in queues for queues in self.queues.values()]
+
+    def _min_virtual_time(self):
+        active = [self.virtual_time[c] for c in self.classes if self._has_waiting(c)]
+        if len(active) == 0:
+            return max(self.virtual_time.values())
+        return min(active)
+
+    def _queue_length(self):
+        return sum([len(q) for queues in self.queues.values() for q in queues.values()])
+
+
+def _percentile(values, p):
+    if len(values) == 0:
+        return None
+    return round(values[min(int(len(values) * p), len(values) - 1)], 3)
@@ -1,3 +1,5 @@
 from .data import data
+from .debug import debug
 from .jobs import jobs
+from .layers import layers
 from .status import status
@@ -1,18 +1,19 @@
 import os.path
 
-from flask import Blueprint, current_app, abort, send_from_directory
+from flask import Blueprint, current_app, abort, request, send_from_directory
 
-from orka_vector_api import db
+from orka_vector_api import db, asset_cache
 from orka_vector_api.exceptions.orka import OrkaException
-from orka_vector_api.helper import get_job_id_by_dataid
+from orka_vector_api.helper import get_job_id_by_dataid, verify_download_token, find_output_file
 
 data = Blueprint('data', __name__, url_prefix='/data')
 
 
 @data.route('/<uuid:data_id>', methods=['GET'])
 def get_data(data_id):
-    """Get a single geopackage.
-    Get the geopackage with given uuid as filename.
+    """Get a single data package.
+    Get the geopackage or mbtiles file with given uuid as filename. If a download
+    token is provided, the download is authorized by the token alone.
     ---
     parameters:
       - name: data_id
@@ -21,15 +22,38 @@ def get_data(data_id):
         type: string
         format: uuid
         required: true
+      - name: token
+        description: The download token that is provided via the corresponding job.
+        in: query
+        type: string
+        required: false
     responses:
       200:
-        description: The geopackage file.
+        description: The geopackage or mbtiles file.
+      403:
+        description: The download token is invalid or expired.
+      404:
+        description: The data package was not found.
     produces:
       - application/geopackage+sqlite3
+      - application/vnd.mapbox-vector-tile+sqlite3
     """
     data_id_str = str(data_id)
     gpkg_path = current_app.config['ORKA_GPKG_PATH']
-    filename = data_id_str + '.gpkg'
+    output_file = find_output_file(gpkg_path, data_id_str)
+    if output_file is None:
+        current_app.logger.info(f'Could not provide download for {data_id_str}. File not found.')
+        return '', 404
+    file_path, output_format = output_file
+    filename = os.path.basename(file_path)
+
+    token = request.args.get('token')
+    if token is not None:
+        if not verify_download_token(current_app, token, data_id_str):
+            current_app.logger.info(f'Could not provide download for {filename}. Invalid download token.')
+            return '', 403
+        current_app.logger.debug(f'Provided download for {filename} by token.')
+        return send_from_directory(os.path.abspath(gpkg_path), filename, mimetype=output_format.mimetype)
 
     conn = db.pool.getconn()
     try:
@@ -38,7 +62,7 @@ def get_data(data_id):
         if job_id is None:
             raise OrkaException('Corresponding job not found.')
         current_app.logger.debug(f'Provided download for {filename} of job {job_id}.')
-        response = send_from_directory(os.path.abspath(gpkg_path), filename, mimetype='application/geopackage+sqlite3')
+        response = send_from_directory(os.path.abspath(gpkg_path), filename, mimetype=output_format.mimetype)
     except OrkaException as e:
         current_app.logger.info(f'Could not provide download for {filename}. No corresponding job found.')
         response = '', 404
@@ -54,33 +78,63 @@ def get_data(data_id):
 @data.route('/styles', methods=['GET'])
 def get_styles_zip():
     """Get the style files, symbols, etc.
-    Get all style files as a single .zip file.
+    Get all style files as a single .zip file. The file is served from memory
+    with an ETag, so clients can revalidate it cheaply. The url with the content
+    hash (see Content-Location) may be cached forever.
     ---
+    parameters:
+      - name: v
+        description: The content hash of the file. If it matches, the response may be cached forever.
+        in: query
+        type: string
+        required: false
     responses:
       200:
         description: The .zip file containing all styles, etc.
+      304:
+        description: The file did not change.
+      404:
+        description: The file does not exist.
     produces:
       - application/zip
     """
-    style_path = current_app.config['ORKA_STYLE_PATH']
-    file_name = current_app.config['ORKA_STYLE_FILE']
-
-    current_app.logger.debug(f'Provided download for style file {file_name}.')
-    return send_from_directory(os.path.abspath(style_path), file_name, mimetype='application/zip')
+    return _get_asset('styles')
 
 
 @data.route('/groups', methods=['GET'])
 def get_layer_groups():
     """Get the configuration of layer groups.
+    The file is served from memory with an ETag, so clients can revalidate it
+    cheaply. The url with the content hash (see Content-Location) may be cached
+    forever.
     ---
+    parameters:
+      - name: v
+        description: The content hash of the file. If it matches, the response may be cached forever.
+        in: query
+        type: string
+        required: false
     responses:
       200:
         description: The layer group configuration json file.
+      304:
+        description: The file did not change.
+      404:
+        description: The file does not exist.
     produces:
       - application/json
     """
-    style_path = current_app.config['ORKA_STYLE_PATH']
-    file_name = current_app.config['ORKA_LAYER_GROUPS_FILE']
+    return _get_asset('groups')
+
+
+def _get_asset(name):
+    response = asset_cache.respond(name, if_none_match=request.headers.get('If-None-Match'),
+                                   accept_encoding=request.headers.get('Accept-Encoding'),
+                                   version=request.args.get('v'))
+    if response is None:
+        current_app.logger.info(f'Could not provide download for {name}. File not found.')
+        return '', 404
 
-    current_app.logger.debug(f'Provided download for layer groups config file {file_name}.')
-    return send_from_directory(os.path.abspath(style_path), file_name, mimetype='application/json')
+    body, code, headers = response
+    current_app.logger.debug(f'Provided download for {name} with status {code}.')
+    return current_app.response_class(body, status=code, headers=headers)
@@ -0,0 +1,66 @@
+from flask import Blueprint, current_app
+
+from orka_vector_api import profiler
+
+debug = Blueprint('debug', __name__, url_prefix='/debug')
+
+
+@debug.route('/profile/<int:job_id>', methods=['GET'])
+def get_profile(job_id):
+    """Get the profile of a job.
+    Get the timing spans of the request that added the job and of its export.
+    Only available if ORKA_PROFILING is enabled, and only for the most recent
+    jobs handled by this process.
+    ---
+    parameters:
+      - name: job_id
+        in: path
+        description: The id of the job.
+        type: integer
+        required: true
+    responses:
+      200:
+        description: The profile of the job.
+        schema:
+          $ref: '#/definitions/Profile'
+      404:
+        description: No profile of the job available.
+    definitions:
+      Profile:
+        type: object
+        properties:
+          started:
+            type: number
+            description: The unix timestamp of the first span.
+          spans:
+            type: array
+            description: The spans ordered by start, e.g. bbox_size_allowed, pool_checkout, queue_wait, ogr2ogr, status_callback.
+            items:
+              type: object
+              properties:
+                name:
+                  type: string
+                start:
+                  type: number
+                  description: The seconds since the first span.
+                seconds:
+                  type: number
+          stacks:
+            type: array
+            description: The most frequent python stacks of the export, if stack sampling is enabled.
+            items:
+              type: object
+              properties:
+                stack:
+                  type: string
+                samples:
+                  type: integer
+          explains:
+            type: object
+            description: The EXPLAIN (ANALYZE, BUFFERS) output of the queries of slow layers.
+    """
+    profile = profiler.to_dict(job_id)
+    if profile is None:
+        current_app.logger.info(f'Could not get profile of job {job_id}. Profile not found.')
+        return '', 404
+    return profile
@@ -1,12 +1,17 @@
 import json
+import time
 import uuid
-from flask import Blueprint, request, abort, current_app
+from flask import Blueprint, request, abort, current_app, url_for
+from psycopg2.errors import UniqueViolation
 
-from orka_vector_api import db
-from orka_vector_api.enums import Status
+from orka_vector_api import db, layer_registry, scheduler, rate_limiter, profiler
+from orka_vector_api.enums import Status, OutputFormat
 from orka_vector_api.exceptions.orka import OrkaException
-from orka_vector_api.helper import create_job, update_job, get_job_by_id, delete_job_by_id, \
-    delete_geopackage, create_gpkg_threaded, threads_available, bbox_size_allowed
+from orka_vector_api.helper import create_job, update_job, update_jobs_by_dataid, get_job_by_id, \
+    delete_job_by_id, delete_geopackage, get_gpkg_task, bbox_size_allowed, get_layer_stats, update_layer_stats, \
+    estimate_eta, get_eta_layers, create_download_token, get_client, get_idempotency_key, get_request_key, \
+    lock_request_key, get_inflight_job, get_job_by_idempotency_key, srids_exist, transition_jobs_by_dataid, \
+    lock_data_id, get_job_id_by_dataid
 
 jobs = Blueprint('jobs', __name__, url_prefix='/jobs')
 
@@ -15,7 +20,10 @@ jobs = Blueprint('jobs', __name__, url_prefix='/jobs')
 def add_job():
     """Add new job.
     Add a new job and trigger the creation of a geopackage containing only
-    the geometries that intersect the provided bounding box.
+    the geometries that intersect the provided bounding box. With format
+    mbtiles, a package of vector tiles is created instead.
+    If a job of the same bounding box, layers and format is still queued or
+    running, the new job is attached to its export and gets the same data package.
     ---
     parameters:
       - name: body
@@ -24,6 +32,11 @@ def add_job():
         schema:
           $ref: '#/definitions/PostBody'
         required: true
+      - name: Idempotency-Key
+        in: header
+        description: Unique key of the request. Repeated requests with the same key return the job of the first request.
+        type: string
+        required: false
     responses:
       400:
         description: BBOX invalid, or BBOX area too big, or server busy.
@@ -37,6 +50,15 @@ def add_job():
           example:
             success: False
             message: "Invalid BBOX"
+      429:
+        description: Too many requests of this client. Retry after the seconds of the Retry-After header.
+        schema:
+          type: object
+          properties:
+            success:
+              type: boolean
+            message:
+              type: string
       201:
         description: The success response.
         schema:
@@ -68,6 +90,23 @@ def add_job():
             items:
               type: string
             required: false
+          format:
+            type: string
+            description: The format of the data package. Defaults to gpkg.
+            enum:
+              - gpkg
+              - mbtiles
+            required: false
+          srid:
+            type: integer
+            description: The EPSG code of the coordinate reference system of the geopackage. Defaults to the configured CRS of each layer.
+            required: false
+          layer_srids:
+            type: object
+            description: The EPSG code of the coordinate reference system of single layers, overriding srid.
+            additionalProperties:
+              type: integer
+            required: false
         example:
           bbox:
             - 12.770159825707431
@@ -88,30 +127,191 @@ def add_job():
         current_app.logger.info('Could not add job. Empty list of layers.')
         return json.dumps({'success': False, 'message': Status.LAYERS_INVALID.value}), 400, {'ContentType': 'application/json'}
 
-    conn = db.pool.getconn()
+    if layers is not None and not layer_registry.has_layers(layers):
+        current_app.logger.info('Could not add job. Unknown layers.')
+        return json.dumps({'success': False, 'message': Status.LAYERS_INVALID.value}), 400, {'ContentType': 'application/json'}
+
+    try:
+        output_format = OutputFormat(post_body.get('format', OutputFormat.GPKG.value))
+    except ValueError:
+        current_app.logger.info('Could not add job. Invalid format.')
+        return json.dumps({'success': False, 'message': Status.FORMAT_INVALID.value}), 400, {'ContentType': 'application/json'}
+
+    srid = post_body.get('srid')
+    layer_srids = post_body.get('layer_srids') or {}
+    if not _is_srid(srid, optional=True) or not isinstance(layer_srids, dict) \
+            or False in [_is_srid(v) for v in layer_srids.values()] \
+            or not layer_registry.has_layers(layer_srids.keys()):
+        current_app.logger.info('Could not add job. Invalid SRID.')
+        return json.dumps({'success': False, 'message': Status.SRID_INVALID.value}), 400, {'ContentType': 'application/json'}
+
+    client = get_client(current_app, request)
+    rate_limited = _rate_limit(client)
+    if rate_limited is not None:
+        return rate_limited
+
+    idempotency_key = get_idempotency_key(current_app, request, client)
+    request_key = get_request_key(bbox, layers=layers, output_format=output_format, srid=srid,
+                                  layer_srids=layer_srids)
+
+    profile = profiler.new_profile()
+    started = time.time()
+    perf_started = time.perf_counter()
+    job_id = None
+    with profile.span('pool_checkout'):
+        conn = db.pool.getconn()
     try:
-        data_id = str(uuid.uuid4())
+        with profile.span('idempotency_lookup'):
+            job_id = _get_idempotent_job_id(conn, idempotency_key, request_key)
+        if job_id is not None:
+            current_app.logger.debug(f'Returning job {job_id} of repeated request')
+            return json.dumps({'success': True, 'job_id': job_id}), 201, {'ContentType': 'application/json'}
 
-        if not bbox_size_allowed(conn, current_app, bbox):
+        with profile.span('bbox_size_allowed'):
+            allowed = bbox_size_allowed(conn, current_app, bbox)
+        if not allowed:
             current_app.logger.info('Could not add job. BBOX size not allowed.')
             raise OrkaException(Status.BBOX_TOO_BIG.value)
 
-        if not threads_available(conn, current_app):
-            current_app.logger.info('Could not add job. No free threads available.')
-            raise OrkaException(Status.NO_THREADS_AVAILABLE.value)
+        srids = [v for v in [srid, *layer_srids.values()] if v is not None]
+        with profile.span('srids_exist'):
+            srids_valid = len(srids) == 0 or srids_exist(conn, srids)
+        if not srids_valid:
+            current_app.logger.info('Could not add job. Unknown SRID.')
+            raise OrkaException(Status.SRID_INVALID.value)
 
-        job_id = create_job(conn, current_app, bbox, data_id, layers=layers)
-        current_app.logger.debug(f'Added job with id {job_id}')
-        update_job(job_id, conn, current_app, status=Status.RUNNING.value)
+        # held until the job is created, so concurrent duplicates find each other
+        with profile.span('coalesce'):
+            lock_request_key(conn, request_key)
+            leader = get_inflight_job(conn, current_app, request_key)
+        if leader is not None:
+            # attach to the running export, both jobs share its data package. The status is copied
+            # while holding the lock of the export, so no status update of the export is missed.
+            with profile.span('create_job', leader=leader['id']):
+                lock_data_id(conn, leader['data_id'])
+                job_id = create_job(conn, current_app, bbox, leader['data_id'], layers=layers,
+                                    output_format=output_format, status=None, idempotency_key=idempotency_key,
+                                    request_key=request_key, srid=srid, layer_srids=layer_srids)
+            current_app.logger.debug(f'Added job with id {job_id} to export of job {leader["id"]}')
+        else:
+            data_id = str(uuid.uuid4())
+            with profile.span('create_job'):
+                job_id = create_job(conn, current_app, bbox, data_id, layers=layers, output_format=output_format,
+                                    status=Status.QUEUED, idempotency_key=idempotency_key,
+                                    request_key=request_key, srid=srid, layer_srids=layer_srids)
+            current_app.logger.debug(f'Added job with id {job_id}')
 
-        current_app.logger.debug(f'Creating gpkg for job {job_id}')
-        create_gpkg_threaded(current_app, job_id, data_id, bbox, layers=layers)
+            current_app.logger.debug(f'Queueing gpkg for job {job_id}')
+            try:
+                target, args, kwargs = get_gpkg_task(current_app, job_id, data_id, bbox, layers=layers,
+                                                      output_format=output_format, srid=srid,
+                                                      layer_srids=layer_srids)
+                with profile.span('submit'):
+                    submitted = scheduler.submit(client['id'], client['priority'], client['max_concurrent'],
+                                                 target, *args, key=data_id, **kwargs)
+            except Exception:
+                # the job would stay queued forever, but jobs that attached in the meantime can be resumed
+                update_jobs_by_dataid(data_id, conn, current_app, status=Status.ERROR.value)
+                delete_job_by_id(job_id, conn, current_app)
+                job_id = None
+                raise
+            if not submitted:
+                current_app.logger.info('Could not add job. Queue is full.')
+                # jobs that attached in the meantime can be resumed
+                update_jobs_by_dataid(data_id, conn, current_app, status=Status.ERROR.value)
+                delete_job_by_id(job_id, conn, current_app)
+                raise OrkaException(Status.NO_THREADS_AVAILABLE.value)
         response = json.dumps({'success': True, 'job_id': job_id}), 201, {'ContentType': 'application/json'}
+    except UniqueViolation:
+        # a concurrent request with the same idempotency key created its job first
+        conn.rollback()
+        response = _get_concurrent_idempotent_response(conn, idempotency_key, request_key)
     except OrkaException as e:
         response = json.dumps({'success': False, 'message': str(e)}), 400, {'ContentType': 'application/json'}
     except Exception as e:
         current_app.logger.info(f'Error adding job. {e}')
         response = json.dumps({'success': False}), 400, {'ContentType': 'application/json'}
+    finally:
+        db.pool.putconn(conn)
+        profile.add_span('add_job', started, time.perf_counter() - perf_started)
+        if job_id is not None:
+            profiler.save(job_id, profile)
+
+    return response
+
+
+@jobs.route('/<int:job_id>/resume', methods=['POST'])
+def resume_job(job_id):
+    """Resume a failed job.
+    Re-runs the export of a job that ended with ERROR or TIMEOUT. Layers that
+    were already exported are kept and only the remaining layers are exported.
+    ---
+    parameters:
+      - name: job_id
+        in: path
+        description: The id of the job.
+        type: integer
+        required: true
+    responses:
+      200:
+        description: The job was resumed.
+        schema:
+          $ref: '#/definitions/PostResponse'
+      400:
+        description: Job cannot be resumed, or server busy.
+        schema:
+          type: object
+          properties:
+            success:
+              type: boolean
+            message:
+              type: string
+      404:
+        description: Job not found.
+      429:
+        description: Too many requests of this client.
+    """
+    client = get_client(current_app, request)
+    rate_limited = _rate_limit(client)
+    if rate_limited is not None:
+        return rate_limited
+
+    conn = db.pool.getconn()
+    try:
+        job = get_job_by_id(job_id, conn, current_app)
+        if job is None:
+            current_app.logger.info(f'Could not resume job {job_id}. Job not found.')
+            response = json.dumps({'success': False}), 404, {'ContentType': 'application/json'}
+            return response
+
+        # all jobs attached to the export are resumed with it, but only by one request
+        resumable = [Status.ERROR.value, Status.TIMEOUT.value]
+        if transition_jobs_by_dataid(job['data_id'], conn, current_app, resumable, Status.QUEUED.value) == 0:
+            current_app.logger.info(f'Could not resume job {job_id}. Job has status {job["status"]}.')
+            raise OrkaException(job['status'] if job['status'] not in resumable else Status.QUEUED.value)
+
+        current_app.logger.debug(f'Resuming gpkg for job {job_id}')
+        bbox = [job['minx'], job['miny'], job['maxx'], job['maxy']]
+        try:
+            target, args, kwargs = get_gpkg_task(current_app, job_id, job['data_id'], bbox, layers=job['layers'],
+                                                  checkpoint=job['progress'],
+                                                  output_format=OutputFormat(job['format']), srid=job['srid'],
+                                                  layer_srids=job['layer_srids'])
+            submitted = scheduler.submit(client['id'], client['priority'], client['max_concurrent'], target, *args,
+                                         key=job['data_id'], **kwargs)
+        except Exception:
+            update_jobs_by_dataid(job['data_id'], conn, current_app, status=job['status'])
+            raise
+        if not submitted:
+            current_app.logger.info('Could not resume job. Queue is full.')
+            update_jobs_by_dataid(job['data_id'], conn, current_app, status=job['status'])
+            raise OrkaException(Status.NO_THREADS_AVAILABLE.value)
+        response = json.dumps({'success': True, 'job_id': job_id}), 200, {'ContentType': 'application/json'}
+    except OrkaException as e:
+        response = json.dumps({'success': False, 'message': str(e)}), 400, {'ContentType': 'application/json'}
+    except Exception as e:
+        current_app.logger.info(f'Error resuming job. {e}')
+        response = json.dumps({'success': False}), 500, {'ContentType': 'application/json'}
     finally:
         db.pool.putconn(conn)
 
@@ -162,11 +362,74 @@ def get_job(job_id):
             items:
               type: str
             description: The list of layers that are contained in the data package. If null, all layers are included.
+          format:
+            type: string
+            description: The format of the data package.
+            enum:
+              - gpkg
+              - mbtiles
+          srid:
+            type: integer
+            description: The requested EPSG code of the geopackage. Null, if the configured CRS of each layer is used.
+          layer_srids:
+            type: object
+            description: The requested EPSG codes of single layers.
+            additionalProperties:
+              type: integer
+          data_id:
+            type: string
+            format: uuid
+            description: The id of the geopackage. Only contained if the status is CREATED.
+          download_token:
+            type: string
+            description: Signed token that grants the download of the geopackage until it expires. Only contained if the status is CREATED.
+          download_url:
+            type: string
+            description: The url of the geopackage including the download token. Only contained if the status is CREATED.
+          progress:
+            $ref: '#/definitions/JobProgress'
+          eta:
+            type: number
+            description: Estimated remaining seconds of a running job. Null, if no estimate is available.
+      JobProgress:
+        description: The progress of the export. Null, until the first progress was reported.
+        type: object
+        properties:
+          layers_total:
+            type: integer
+            description: The number of layers to export.
+          layers_done:
+            type: integer
+            description: The number of layers that are already exported.
+          elapsed:
+            type: number
+            description: The elapsed seconds of the export at the time of the last report.
+          pending:
+            type: array
+            items:
+              type: string
+            description: The layers that are not yet exported.
+          layers:
+            type: object
+            description: Rows, bytes and seconds for each exported layer.
+            additionalProperties:
+              type: object
+              properties:
+                rows:
+                  type: integer
+                bytes:
+                  type: integer
+                seconds:
+                  type: number
+                resumed:
+                  type: boolean
+                  description: Whether the layer was exported by a previous run of a resumed job.
       JobStatus:
         description: The status of a Job.
         type: string
         enum:
           - INIT
+          - QUEUED
           - RUNNING
           - CREATED
           - ERROR
@@ -183,6 +446,14 @@ def get_job(job_id):
             raise OrkaException("Job not found.")
         if job['status'] != Status.CREATED.value:
             job.pop('data_id')
+        else:
+            token = create_download_token(current_app, job['data_id'])
+            job['download_token'] = token
+            job['download_url'] = url_for('data.get_data', data_id=job['data_id'], token=token)
+        job['eta'] = None
+        if job['status'] == Status.RUNNING.value and job['progress'] is not None:
+            layer_stats = get_layer_stats(conn, current_app, get_eta_layers(job['progress']))
+            job['eta'] = estimate_eta(job['progress'], layer_stats)
         response = job
     except OrkaException as e:
         response = '', 404
@@ -233,6 +504,15 @@ def put_job(job_id):
             current_app.logger.info(f'Could not update job {job_id}. Job not found.')
             raise OrkaException("Job not found.")
         update_job(job_id, conn, current_app, **post_body)
+        # jobs attached to the same export follow its status
+        shared = {k: v for k, v in post_body.items() if k in ['status', 'progress']}
+        if job['data_id'] is not None and len(shared) > 0:
+            lock_data_id(conn, job['data_id'])
+            update_jobs_by_dataid(job['data_id'], conn, current_app, **shared)
+        # the progress of vector tiles has zoom levels instead of layers
+        if post_body.get('status') == Status.CREATED.value and post_body.get('progress') is not None \
+                and job['format'] == OutputFormat.GPKG.value and _records_layer_stats():
+            update_layer_stats(conn, current_app, json.loads(post_body['progress']))
         response = json.dumps({'success': True}), 201, {'ContentType': 'application/json'}
     except OrkaException:
         response = json.dumps({'success': False}), 404, {'ContentType': 'application/json'}
@@ -245,10 +525,66 @@ def put_job(job_id):
     return response
 
 
+@jobs.route('/exports/<data_id>', methods=['PUT'])
+def put_export(data_id):
+    """Update all jobs of an export.
+    Used by the export to report its status and progress. All jobs that share
+    the data package are updated, even if the job that started the export was
+    deleted in the meantime.
+    ---
+    parameters:
+      - name: data_id
+        in: path
+        description: The data id of the export.
+        type: string
+        required: true
+      - name: body
+        in: body
+        description: The status and progress of the export.
+        required: true
+        schema:
+          $ref: '#/definitions/Job'
+    responses:
+      201:
+        description: Successfully updated.
+        schema:
+          $ref: '#/definitions/PutResponse'
+      404:
+        description: No job of the export found.
+    """
+    post_body = request.json
+    conn = db.pool.getconn()
+    try:
+        shared = {k: v for k, v in post_body.items() if k in ['status', 'progress']}
+        # waits for jobs that are attaching to the export right now
+        lock_data_id(conn, data_id)
+        updated = update_jobs_by_dataid(data_id, conn, current_app, **shared)
+        if updated == 0:
+            current_app.logger.info(f'Could not update export {data_id}. No job found.')
+            raise OrkaException("Export not found.")
+        if post_body.get('status') == Status.CREATED.value and post_body.get('progress') is not None \
+                and _records_layer_stats():
+            job = get_job_by_id(get_job_id_by_dataid(data_id, conn, current_app), conn, current_app)
+            # the progress of vector tiles has zoom levels instead of layers
+            if job is not None and job['format'] == OutputFormat.GPKG.value:
+                update_layer_stats(conn, current_app, json.loads(post_body['progress']))
+        response = json.dumps({'success': True}), 201, {'ContentType': 'application/json'}
+    except OrkaException:
+        response = json.dumps({'success': False}), 404, {'ContentType': 'application/json'}
+    except Exception as e:
+        current_app.logger.info(f'Error updating export. {e}')
+        response = json.dumps({'success': False}), 500, {'ContentType': 'application/json'}
+    finally:
+        db.pool.putconn(conn)
+
+    return response
+
+
 @jobs.route('/<int:job_id>', methods=['DELETE'])
 def delete_job(job_id):
     """Delete a job.
-    Deletes a job and the corresponding geopackage file.
+    Deletes a job and the corresponding geopackage file, unless other jobs
+    share the geopackage.
     ---
     parameters:
       - name: job_id
@@ -284,15 +620,16 @@ def delete_job(job_id):
             current_app.logger.info(f'Could not delete job {job_id}. Job not found.')
             raise OrkaException("Job not found")
 
-        deleted_gpkg = delete_geopackage(job.get('data_id'), conn, current_app)
-        if not deleted_gpkg:
-            current_app.logger.info(f'Could not delete gpkg for job {job_id}')
-
         deleted = delete_job_by_id(job_id, conn, current_app)
         if not deleted:
             current_app.logger.info(f'Could not delete job with id {job_id}')
             raise OrkaException('Could not delete job.')
 
+        # the gpkg is kept as long as other jobs share it
+        deleted_gpkg = delete_geopackage(job.get('data_id'), conn, current_app)
+        if not deleted_gpkg:
+            current_app.logger.info(f'Did not delete gpkg for job {job_id}')
+
         current_app.logger.debug(f'Deleted job with id {job_id}')
         response = json.dumps({'success': True}), 200, {'ContentType': 'application/json'}
     except OrkaException as e:
@@ -304,3 +641,54 @@ def delete_job(job_id):
         db.pool.putconn(conn)
 
     return response
+
+
+def _is_srid(srid, optional=False):
+    if srid is None:
+        return optional
+    return isinstance(srid, int) and not isinstance(srid, bool) and srid > 0
+
+
+def _get_idempotent_job_id(conn, idempotency_key, request_key):
+    if idempotency_key is None:
+        return None
+
+    job = get_job_by_idempotency_key(conn, current_app, idempotency_key)
+    if job is None:
+        return None
+    if job['request_key'] != request_key:
+        current_app.logger.info(f'Idempotency key of job {job["id"]} reused for a different request.')
+        raise OrkaException(Status.IDEMPOTENCY_KEY_REUSED.value)
+    return job['id']
+
+
+def _get_concurrent_idempotent_response(conn, idempotency_key, request_key):
+    try:
+        existing_job_id = _get_idempotent_job_id(conn, idempotency_key, request_key)
+        if existing_job_id is None:
+            current_app.logger.info('Could not add job. Job of the concurrent request with the same idempotency key '
+                                    'was deleted.')
+            return json.dumps({'success': False}), 400, {'ContentType': 'application/json'}
+        return json.dumps({'success': True, 'job_id': existing_job_id}), 201, {'ContentType': 'application/json'}
+    except OrkaException as e:
+        return json.dumps({'success': False, 'message': str(e)}), 400, {'ContentType': 'application/json'}
+    except Exception as e:
+        current_app.logger.info(f'Error adding job. {e}')
+        return json.dumps({'success': False}), 400, {'ContentType': 'application/json'}
+
+
+def _records_layer_stats():
+    # the durations of the fake engine would distort the estimates of real exports
+    return current_app.config['ORKA_EXPORT_ENGINE'] != 'fake'
+
+
+def _rate_limit(client):
+    allowed, retry_after = rate_limiter.acquire(client['id'], client['rate'], client['burst'])
+    if allowed:
+        return None
+
+    current_app.logger.info(f'Client {client["id"]} is rate limited.')
+    return json.dumps({'success': False, 'message': Status.RATE_LIMITED.value}), 429, {
+        'ContentType': 'application/json',
+        'Retry-After': str(max(int(retry_after + 0.999), 1))
+    }
@@ -0,0 +1,146 @@
+import json
+
+from flask import Blueprint, request, current_app, jsonify
+
+from orka_vector_api import db, layer_registry
+from orka_vector_api.enums import Status
+
+layers = Blueprint('layers', __name__, url_prefix='/layers')
+
+
+@layers.route('/', methods=['GET'])
+def get_layers():
+    """Get all available layers.
+    Get the layers that can be requested in a job, including statistics about
+    their data. The statistics are refreshed periodically and are null until
+    the first refresh.
+    ---
+    responses:
+      200:
+        description: The list of layers.
+        schema:
+          type: array
+          items:
+            $ref: '#/definitions/Layer'
+    definitions:
+      Layer:
+        type: object
+        properties:
+          name:
+            type: string
+            description: The name of the layer.
+          valid:
+            type: boolean
+            description: False, if the sql of the layer is invalid. Invalid layers cannot be requested.
+          error:
+            type: string
+            description: The reason why the layer is invalid or its statistics are unavailable.
+          srid:
+            type: integer
+            description: The SRID of the layer geometries.
+          extent:
+            type: array
+            description: The estimated extent of the layer in EPSG 4326 with [xMin, yMin, xMax, yMax].
+            items:
+              type: number
+          feature_count:
+            type: integer
+            description: The estimated number of features.
+          avg_feature_size:
+            type: integer
+            description: The estimated average size of a feature in bytes.
+          columns:
+            type: array
+            description: The columns of the layer.
+            items:
+              type: string
+          updated:
+            type: number
+            description: The unix timestamp of the last refresh of the statistics.
+    """
+    return jsonify(layer_registry.get_catalog())
+
+
+@layers.route('/estimate', methods=['POST'])
+def estimate_layers():
+    """Estimate the size of a data package.
+    Estimate the number of features and the size of each layer within the
+    bounding box, without starting a job. The estimates are taken from the
+    database statistics.
+    ---
+    parameters:
+      - name: body
+        in: body
+        description: The bounding box and layers, as for a new job.
+        schema:
+          $ref: '#/definitions/PostBody'
+        required: true
+    responses:
+      400:
+        description: BBOX invalid, or layers invalid.
+        schema:
+          type: object
+          properties:
+            success:
+              type: boolean
+            message:
+              type: string
+      200:
+        description: The estimate.
+        schema:
+          $ref: '#/definitions/Estimate'
+    definitions:
+      Estimate:
+        type: object
+        properties:
+          success:
+            type: boolean
+          bytes:
+            type: integer
+            description: The estimated size of all layers in bytes.
+          features:
+            type: integer
+            description: The estimated number of features of all layers.
+          layers:
+            type: object
+            description: The estimated number of features and size in bytes of each layer.
+            additionalProperties:
+              type: object
+              properties:
+                features:
+                  type: integer
+                bytes:
+                  type: integer
+    """
+    post_body = request.json
+
+    bbox = post_body.get('bbox')
+    try:
+        bbox = [float(b) for b in bbox]
+    except (TypeError, ValueError):
+        bbox = None
+    if bbox is None or not len(bbox) == 4:
+        current_app.logger.info('Could not estimate. Invalid BBOX.')
+        return json.dumps({'success': False, 'message': Status.BBOX_INVALID.value}), 400, {'ContentType': 'application/json'}
+
+    layer_names = post_body.get('layers')
+    if layer_names is not None and (len(layer_names) == 0 or not layer_registry.has_layers(layer_names)):
+        current_app.logger.info('Could not estimate. Invalid list of layers.')
+        return json.dumps({'success': False, 'message': Status.LAYERS_INVALID.value}), 400, {'ContentType': 'application/json'}
+
+    conn = db.source_pool.getconn()
+    try:
+        estimates = layer_registry.estimate(conn, bbox, layer_names)
+        response = json.dumps({
+            'success': True,
+            'bytes': sum([e['bytes'] for e in estimates.values()]),
+            'features': sum([e['features'] for e in estimates.values()]),
+            'layers': estimates
+        }), 200, {'ContentType': 'application/json'}
+    except Exception as e:
+        current_app.logger.info(f'Error estimating layers. {e}')
+        response = json.dumps({'success': False}), 500, {'ContentType': 'application/json'}
+    finally:
+        db.source_pool.putconn(conn)
+
+    return response
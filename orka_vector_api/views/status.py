@@ -1,5 +1,7 @@
 from flask import Blueprint
 
+from orka_vector_api import scheduler
+
 status = Blueprint('status', __name__, url_prefix='/status')
 
 
@@ -27,3 +29,42 @@ def get_status():
     return {
         'status': 'active'
     }
+
+
+@status.route('/queue')
+def get_queue():
+    """ Get the state of the job queue of this process.
+    ---
+    responses:
+      200:
+        description: The number of queued and running jobs and the waiting times per priority class.
+        content:
+          application/json:
+            schema:
+              $ref: '#/definitions/QueueStatus'
+    definitions:
+      QueueStatus:
+        type: object
+        properties:
+          slots:
+            type: integer
+            description: The number of jobs that can run at once.
+          classes:
+            type: object
+            description: The state of each priority class.
+            additionalProperties:
+              type: object
+              properties:
+                queued:
+                  type: integer
+                running:
+                  type: integer
+                wait_p50:
+                  type: number
+                  description: The median seconds jobs waited in the queue.
+                wait_p95:
+                  type: number
+                wait_max:
+                  type: number
+    """
+    return scheduler.get_metrics()
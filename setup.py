@@ -25,4 +25,18 @@ setup(
         'requests~=2.25.1',
         'flasgger~=0.9.5'
     ],
+    extras_require={
+        'asgi': [
+            'starlette~=0.14.2',
+            # FileResponse of starlette 0.14 streams files with aiofiles
+            'aiofiles~=0.7.0',
+            'asyncpg~=0.22.0',
+            'uvicorn~=0.14.0'
+        ]
+    },
+    entry_points={
+        'console_scripts': [
+            'orka-loadtest=orka_vector_api.loadtest:main'
+        ]
+    },
 )